@@ -0,0 +1,210 @@
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+import numpy as np
+
+from pos_tagger import POSTagger
+from tagger_utils import load_data
+
+
+DECODERS = {1: "greedy", 2: "beam", 3: "viterbi"}
+
+# higher is better for these metrics, lower for all the others
+HIGHER_IS_BETTER = ("tokens_per_sec",)
+
+
+def run_timed(func, repeat):
+    """Calls func repeat times and keeps the fastest run.
+
+    Returns:
+        result: return value of the last call
+        float: seconds taken by the fastest call
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def peak_memory(func):
+    """Returns the peak memory in MB allocated while func runs, numpy arrays included. """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(func, tokens, repeat, memory_func=None):
+    """Times func and measures its peak memory.
+
+    Args:
+        func (callable): work to measure, taking no arguments
+        tokens (int): number of tokens func processes
+        repeat (int): number of timed runs, the fastest is kept
+        memory_func (callable): smaller work reaching the same peak memory, as tracing
+            allocations slows func down several times (func itself by default)
+
+    Returns:
+        result: return value of func
+        dict: seconds, tokens_per_sec and peak_memory_mb
+    """
+    result, seconds = run_timed(func, repeat)
+    memory = peak_memory(memory_func or func)
+    return result, {"seconds": seconds, "tokens_per_sec": tokens / seconds, "peak_memory_mb": memory}
+
+
+def document_latencies(model, sentences):
+    """Returns the percentiles of the time in ms taken to tag each document on its own. """
+    model.oov_cache.clear()
+    latencies = []
+    for sentence in sentences:
+        start = time.perf_counter()
+        model.inference_batch([sentence])
+        latencies.append((time.perf_counter() - start) * 1000)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {"latency_p50_ms": p50, "latency_p90_ms": p90, "latency_p99_ms": p99}
+
+
+def run_benchmarks(sentence_file, tag_file, repeat, train_sentence_file=None, train_tag_file=None, holdout=0.5):
+    """Runs every benchmark on a tagged data set.
+
+    The decoders tag documents the model was not trained on, so that unknown words (suffix
+    tries, the unknown word cache and their wider lattices) take their real share of the time:
+    the model is trained on the train files if given, otherwise on the documents of the data
+    set before its last holdout fraction, which is decoded. The unknown word cache is emptied
+    before every timed run.
+
+    Returns:
+        dict: metrics of each benchmark, by name
+    """
+    results = {}
+
+    # the number of tokens is only known once the data is loaded
+    data, stats = benchmark(lambda: load_data(sentence_file, tag_file), 0, repeat)
+    stats["tokens_per_sec"] = sum(len(sentence) for sentence in data[0]) / stats["seconds"]
+    results["load_data"] = stats
+
+    if train_sentence_file:
+        train_data, sentences = load_data(train_sentence_file, train_tag_file), data[0]
+    else:
+        cut = int(len(data[0]) * (1 - holdout))
+        train_data, sentences = (data[0][:cut], data[1][:cut]), data[0][cut:]
+
+    def train():
+        model = POSTagger()
+        model.train(train_data)
+        return model
+    model, results["train"] = benchmark(train, sum(len(sentence) for sentence in train_data[0]), repeat)
+
+    tokens = sum(len(sentence) for sentence in sentences)
+    unknown = sum(word not in model.word2idx for sentence in sentences for word in sentence)
+    print(f"decoding {len(sentences)} documents, {unknown / tokens:.1%} of the tokens unknown", file=sys.stderr)
+
+    def decode(batch):
+        model.oov_cache.clear()
+        return model.inference_batch(batch)
+
+    # inference_batch decodes sentences in batches of similar length, so the batch of the
+    # longest ones needs the most memory
+    longest = sorted(sentences, key=len)[-model.batch_size:]
+
+    for kgram in (2, 3):
+        for decoder in (1, 2, 3):
+            model.kgram, model.model = kgram, decoder
+            name = f"{DECODERS[decoder]}-kgram{kgram}"
+            print(f"running {name}", file=sys.stderr)
+
+            # beam decodes one sentence at a time, so the longest one needs the most memory
+            peak = longest[-1:] if decoder == 2 else longest
+            _, stats = benchmark(lambda: decode(sentences), tokens, repeat, lambda: decode(peak))
+            stats.update(document_latencies(model, sentences))
+            results[name] = stats
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Compares benchmark results to a baseline run.
+
+    Args:
+        results (dict): metrics of each benchmark, by name
+        baseline (dict): metrics of a previous run, by name
+        threshold (float): relative change of a metric, in the wrong direction, counted as a regression
+
+    Returns:
+        list[str]: one line for each regression
+    """
+    regressions = []
+    for name, stats in results.items():
+        for metric, value in stats.items():
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+            change = (value - old) / old
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                regressions.append(f"{name} {metric}: {old:.4g} -> {value:.4g} ({change:+.1%} worse)")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+
+    parser.add_argument("-x", "--sentences", dest = "sentence_path", default = "data/dev_x.csv",
+        help = "path to the id,word file to benchmark on")
+
+    parser.add_argument("-y", "--tags", dest = "tag_path", default = "data/dev_y.csv",
+        help = "path to the id,tag file of the same sentences")
+
+    parser.add_argument("-X", "--train-sentences", dest = "train_sentence_path",
+        help = "path to the id,word file to train on, instead of the first part of the benchmark file")
+
+    parser.add_argument("-Y", "--train-tags", dest = "train_tag_path",
+        help = "path to the id,tag file of the training sentences")
+
+    parser.add_argument("-u", "--holdout", dest = "holdout", type = float, default = 0.5,
+        help = "fraction of the benchmark documents held out from training and decoded, without -X")
+
+    parser.add_argument("-n", "--repeat", dest = "repeat", type = int, default = 3,
+        help = "number of timed runs of each benchmark, the fastest is kept")
+
+    parser.add_argument("-o", "--output", dest = "output_path", default = "benchmark.json",
+        help = "path of the JSON results file to write")
+
+    parser.add_argument("-b", "--baseline", dest = "baseline_path",
+        help = "JSON results of a previous run to compare against")
+
+    parser.add_argument("-r", "--threshold", dest = "threshold", type = float, default = 0.1,
+        help = "relative slowdown or memory growth counted as a regression")
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sentence_path, args.tag_path, args.repeat,
+                             args.train_sentence_path, args.train_tag_path, args.holdout)
+
+    with open(args.output_path, "w") as f:
+        json.dump({"python": platform.python_version(), "numpy": np.__version__, "results": results}, f, indent=2)
+
+    for name, stats in results.items():
+        print(f"{name:16} {stats['seconds']:8.3f}s {stats['tokens_per_sec']:12.0f} tokens/s "
+              f"{stats['peak_memory_mb']:8.1f} MB"
+              + (f"  p50 {stats['latency_p50_ms']:.2f} ms  p99 {stats['latency_p99_ms']:.2f} ms"
+                 if "latency_p50_ms" in stats else ""))
+
+    if args.baseline_path:
+        with open(args.baseline_path) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            sys.exit(1)
+        print(f"no regression beyond {args.threshold:.0%} against {args.baseline_path}")
@@ -1,51 +1,149 @@
 import numpy as np
 import pandas as pd
-from sklearn.metrics import f1_score, confusion_matrix
 from argparse import ArgumentParser
 
 
-def warn(*args, **kwargs): pass
-import warnings; warnings.warn = warn
+""" Scores id,tag prediction files against the gold tags of the same ids. """
 
+# tag given to the gold ids that a prediction file leaves out
+MISSING = "<missing>"
 
-parser = ArgumentParser()
+def encode(tags, vocab):
+    """Maps tags to integer codes, giving the tags never seen before the next free codes.
 
-parser.add_argument("-p", "--predicted", dest = "pred_path",
-    required = True, help = "path to your model's predicted labels file")
+    Args:
+        tags (np.ndarray): tags to encode
+        vocab (dict): code of each tag seen so far, updated in place
 
-parser.add_argument("-d", "--development", dest = "dev_path",
-    required = True, help = "path to the development labels file")
+    Returns:
+        np.ndarray: code of every tag
+    """
+    codes, uniques = pd.factorize(tags)
+    for tag in uniques:
+        if tag not in vocab:
+            vocab[tag] = len(vocab)
+    return np.array([vocab[tag] for tag in uniques], dtype=np.int64)[codes]
 
-parser.add_argument("-c", "--confusion", dest = "show_confusion",
-    action = "store_true", help = "show confusion matrix")
 
-args = parser.parse_args()
+def load_gold(path, vocab, chunksize=1000000):
+    """Reads the gold id,tag file in chunks and encodes its tags.
 
+    Returns:
+        pd.Index: ids, in file order
+        np.ndarray: gold tag code of each id
+    """
+    ids, gold = [], []
+    for chunk in pd.read_csv(path, chunksize=chunksize, keep_default_na=False):
+        ids.append(chunk["id"].to_numpy())
+        gold.append(encode(chunk["tag"].astype(str).to_numpy(), vocab))
+    return pd.Index(np.concatenate(ids)), np.concatenate(gold)
 
-pred = pd.read_csv(args.pred_path, index_col = "id")
-dev  = pd.read_csv(args.dev_path,  index_col = "id")
 
-pred.columns = ["predicted"]
-dev.columns  = ["actual"]
+def score(path, ids, gold, vocab, chunksize=1000000):
+    """Counts every (gold tag, predicted tag) pair of a prediction file, streaming it in chunks.
 
-data = dev.join(pred)
+    Ids missing from the prediction file are counted as predicted with the MISSING tag, and
+    ids missing from the gold file are left out, like a left join on the gold ids.
 
+    Args:
+        path (str): id,tag prediction file
+        ids (pd.Index): gold ids
+        gold (np.ndarray): gold tag code of each id
+        vocab (dict): code of each tag, updated in place with new predicted tags
 
-if args.show_confusion:
-    
-    data["count"] = 1
-    counts = data.groupby(["actual", "predicted"]).count().reset_index()
-    confusion = counts[counts.actual != counts.predicted].reset_index(drop = True)
-        
-    print("Confusion Matrix:")
-    
-    if confusion.empty: print("None!")
-    else: print(confusion)
+    Returns:
+        np.ndarray: confusion counts indexed by (gold code, predicted code), over every code in vocab
+    """
+    pred = np.full(len(gold), encode(np.array([MISSING]), vocab)[0])
+    for chunk in pd.read_csv(path, chunksize=chunksize, keep_default_na=False):
+        rows = ids.get_indexer(chunk["id"].to_numpy())
+        codes = encode(chunk["tag"].astype(str).to_numpy(), vocab)
+        pred[rows[rows >= 0]] = codes[rows >= 0]
 
-else:
+    # every (gold, predicted) pair in one bincount
+    n = len(vocab)
+    return np.bincount(gold * n + pred, minlength=n*n).reshape(n, n)
 
-    print("Mean F1 Score:", f1_score(
-        data.actual,
-        data.predicted,
-        average = "weighted"
-    ))
+
+def per_tag_scores(confusion, tags):
+    """Computes the precision, recall and F1 of every tag found in the gold or predicted tags.
+
+    Like scikit-learn, a tag never predicted (or never in the gold tags) gets a precision
+    (or recall) of 0, and so does the F1 of a tag with both at 0.
+
+    Returns:
+        pd.DataFrame: precision, recall, f1 and support (number of gold tags) of each tag
+    """
+    tp = np.diag(confusion)
+    support = confusion.sum(axis=1)
+    predicted = confusion.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(predicted > 0, tp / predicted, 0.0)
+        recall = np.where(support > 0, tp / support, 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+    scores = pd.DataFrame({"precision": precision, "recall": recall, "f1": f1, "support": support}, index=tags)
+    scores.index.name = "tag"
+    return scores[(support > 0) | (predicted > 0)]
+
+
+def weighted_f1(scores):
+    """Mean F1 of the tags weighted by their support, as scikit-learn's average="weighted". """
+    return (scores.f1 * scores.support).sum() / scores.support.sum()
+
+
+def confusion_pairs(confusion, tags):
+    """Lists the (actual, predicted) pairs that differ, with their counts, sorted by tags. """
+    actual, predicted = np.nonzero(confusion)
+    pairs = pd.DataFrame({"actual": np.array(tags, dtype=object)[actual],
+                          "predicted": np.array(tags, dtype=object)[predicted],
+                          "count": confusion[actual, predicted]})
+    pairs = pairs[pairs.actual != pairs.predicted]
+    return pairs.sort_values(["actual", "predicted"]).reset_index(drop = True)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+
+    parser.add_argument("-p", "--predicted", dest = "pred_paths", nargs = "+",
+        required = True, help = "paths to your models' predicted labels files")
+
+    parser.add_argument("-d", "--development", dest = "dev_path",
+        required = True, help = "path to the development labels file")
+
+    parser.add_argument("-c", "--confusion", dest = "show_confusion",
+        action = "store_true", help = "show confusion matrix")
+
+    parser.add_argument("-t", "--per-tag", dest = "show_per_tag",
+        action = "store_true", help = "show the precision, recall and F1 of every tag")
+
+    parser.add_argument("-s", "--chunksize", dest = "chunksize", type = int, default = 1000000,
+        help = "number of rows read at once from each file")
+
+    args = parser.parse_args()
+
+
+    vocab = {}
+    ids, gold = load_gold(args.dev_path, vocab, args.chunksize)
+
+    for pred_path in args.pred_paths:
+        confusion = score(pred_path, ids, gold, vocab, args.chunksize)
+        tags = list(vocab)
+        prefix = f"{pred_path}: " if len(args.pred_paths) > 1 else ""
+
+        if args.show_confusion:
+
+            confusion = confusion_pairs(confusion, tags)
+
+            print(f"{prefix}Confusion Matrix:")
+
+            if confusion.empty: print("None!")
+            else: print(confusion)
+
+        else:
+
+            scores = per_tag_scores(confusion, tags)
+            print(f"{prefix}Mean F1 Score:", weighted_f1(scores))
+
+            if args.show_per_tag:
+                print(scores.to_string())
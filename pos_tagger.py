@@ -3,17 +3,22 @@ import numpy as np
 import pandas as pd
 import time
 from tagger_utils import *
-from math import log
 import math
 import csv
+import json
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
 from collections import defaultdict 
 from collections import Counter
+from collections import OrderedDict
 import copy
 from itertools import permutations
 
 """ Contains the part of speech tagger class. """
 
-def evaluate(data, model):
+def evaluate(data, model, processes=4, confusion_file='cm.png'):
     """Evaluates the POS model on some sentences and gold tags.
 
     This model can compute a few different accuracies:
@@ -25,77 +30,239 @@ def evaluate(data, model):
     or you can use it as is. 
     
     As per the write-up, you may find it faster to use multiprocessing (code included). 
+    Inference runs on a TaggerPool of `processes` workers, while the log probabilities of the
+    gold tags are computed for the whole set at once by model.sequence_log_probabilities.
+
+    The metrics are computed on flat integer arrays over every token (gold and predicted tag
+    indices, unknown word mask, sentence ids), so they take milliseconds even for millions
+    of tokens. The confusion matrix heatmap is saved to confusion_file, or skipped if it is None.
     
     """
-    processes = 4
-    sentences = data[0]
-    tags = data[1]
+    if isinstance(data, Corpus):
+        sentences, tags = data, None
+    else:
+        sentences, tags = data
     n = len(sentences)
-    k = n//processes
-    n_tokens = sum([len(d) for d in sentences])
-    unk_n_tokens = sum([1 for s in sentences for w in s if w not in model.word2idx.keys()])
-    predictions = {i:None for i in range(n)}
-    probabilities = {i:None for i in range(n)}
-         
-    start = time.time()
-    pool = Pool(processes=processes)
-    res = []
 
-    for i in range(0, n, k):
-        res.append(pool.apply_async(infer_sentences, [model, sentences[i:i+k], i]))
-    
+    with TaggerPool(model, processes) as pool:
+        start = time.time()
+        predictions = pool.tag(sentences)
+        print(f"Inference Runtime: {(time.time()-start)/60} minutes.")
 
-    ans = [r.get(timeout=None) for r in res]
-    predictions = dict()
-    for a in ans:
-        predictions.update(a)
-    print(f"Inference Runtime: {(time.time()-start)/60} minutes.")
-    
     start = time.time()
-    pool = Pool(processes=processes)
-    res = []
-    for i in range(0, n, k):
-        res.append(pool.apply_async(compute_prob, [model, sentences[i:i+k], tags[i:i+k], i]))
-    ans = [r.get(timeout=None) for r in res]
-    probabilities = dict()
-    for a in ans:
-        probabilities.update(a)
-    
+    log_probabilities = model.sequence_log_probabilities(sentences, tags)
     print(f"Probability Estimation Runtime: {(time.time()-start)/60} minutes.")
 
-    token_acc = sum([1 for i in range(n) for j in range(len(sentences[i])) if tags[i][j] == predictions[i][j]]) / n_tokens
-    unk_token_acc = sum([1 for i in range(n) for j in range(len(sentences[i])) if tags[i][j] == predictions[i][j] and sentences[i][j] not in model.word2idx.keys()]) / unk_n_tokens
-    whole_sent_acc = 0
-    num_whole_sent = 0
-    for k in range(n):
-        sent = sentences[k]
-        eos_idxes = indices(sent, '.')
-        start_idx = 1
-        end_idx = eos_idxes[0]
-        for i in range(1, len(eos_idxes)):
-            whole_sent_acc += 1 if tags[k][start_idx:end_idx] == predictions[k][start_idx:end_idx] else 0
-            num_whole_sent += 1
-            start_idx = end_idx+1
-            end_idx = eos_idxes[i]
+    # flat arrays over every token of every document
+    lengths = document_lengths(sentences)
+    if isinstance(data, Corpus): # looked up once per distinct word and tag
+        gold = encode_tags(model.tag2idx, [data.tags])[data.tag_ids]
+        unknown = ~pd.Index(data.words).isin(model.all_words)[data.word_ids]
+        eos = (data.words == '.')[data.word_ids]
+    else:
+        words = pd.Series([w for s in sentences for w in s], dtype=object)
+        gold = encode_tags(model.tag2idx, tags)
+        unknown = ~words.isin(model.all_words).to_numpy()
+        eos = (words == '.').to_numpy()
+    pred = encode_tags(model.tag2idx, predictions.values())
+    correct = (gold == pred) & (gold >= 0)
+
+    token_acc = correct.mean()
+    unk_token_acc = correct[unknown].mean()
+
+    # sentences are the spans between consecutive '.' of a document, leaving out the first
+    # word of the document, the '.' themselves and the words from the last '.' on
+    doc = np.repeat(np.arange(n), lengths)
+    position = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    n_eos = np.bincount(doc, weights=eos, minlength=n).astype(np.int64)
+    before = np.cumsum(eos) - eos - np.repeat(np.cumsum(n_eos) - n_eos, lengths) # '.' before each word in its document
+    n_sents = np.maximum(n_eos - 1, 0)
+    in_sent = ~eos & (position > 0) & (before < n_sents[doc])
+    sent_id = np.repeat(np.cumsum(n_sents) - n_sents, lengths) + before
+    wrong = np.bincount(sent_id[in_sent & ~correct], minlength=n_sents.sum())
+    whole_sent_acc = (wrong == 0).sum()
+    num_whole_sent = n_sents.sum()
+
     print("Whole sent acc: {}".format(whole_sent_acc/num_whole_sent))
-    print("Mean Probabilities: {}".format(sum(probabilities.values())/n))
+    # a gold tag never seen with its word in training gives its sentence a probability of 0
+    possible = log_probabilities > -math.inf
+    print("Mean Log Probability: {} ({} sentences of probability 0 left out)".format(
+        log_probabilities[possible].mean(), n - possible.sum()))
     print("Token acc: {}".format(token_acc))
     print("Unk token acc: {}".format(unk_token_acc))
     
-    confusion_matrix(pos_tagger.tag2idx, pos_tagger.idx2tag, predictions.values(), tags, 'cm.png')
+    matrix = tag_confusion(gold, pred, len(model.tag2idx))
+    if confusion_file is not None:
+        save_heatmap(matrix, model.idx2tag, confusion_file)
 
-    return whole_sent_acc/num_whole_sent, token_acc, sum(probabilities.values())/n
+    return whole_sent_acc/num_whole_sent, token_acc, log_probabilities[possible].mean()
+
+
+# model of a TaggerPool worker process, loaded once when the worker starts
+worker_model = None
+
+def attach_model(path, instrument=False):
+    """TaggerPool worker initializer: memory-maps the shared copy of the model. """
+    global worker_model
+    worker_model = POSTagger.load(path)
+    if instrument:
+        worker_model.metrics = Metrics()
+
+def run_chunk(task):
+    """Runs one TaggerPool task on the worker's model.
+
+    Returns:
+        tuple(list[int], list, Metrics): sentence indices of the chunk, the result for each of
+            them and the metrics collected meanwhile (None without instrumentation)
+    """
+    func, idx, *columns = task
+    res = func(worker_model, *columns, 0)
+
+    metrics = worker_model.metrics
+    if metrics is not None: # send them back with the results and start afresh
+        worker_model.metrics = Metrics()
+    return idx, [res[i] for i in range(len(idx))], metrics
+
+
+class TaggerPool():
+    """A persistent pool of worker processes sharing one copy of a model.
+
+    The model is saved once to a temporary directory (in /dev/shm when available) and every
+    worker memory-maps it when it starts, so the tables live once in shared memory and tasks
+    only carry sentences. Sentences are handed out longest first in chunks of about the same
+    number of tokens, which idle workers pick up as they finish.
+
+    If the model collects metrics, so do the workers, and map adds theirs to the model's.
+
+    Use as a context manager, or call close() when done.
+    """
+    def __init__(self, model, processes=4, chunks_per_process=4):
+        self.model = model
+        self.processes = processes
+        self.chunks_per_process = chunks_per_process
+        self.metrics = model.metrics
+        self.path = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        model.save(self.path)
+        self.pool = Pool(processes=processes, initializer=attach_model, initargs=(self.path, self.metrics is not None))
+
+    def map(self, func, sentences, *columns):
+        """Runs func(model, sentences, *columns, start) over token-balanced chunks of sentences.
+
+        Args:
+            func (callable): infer_sentences or any function with its signature
+            sentences (list[list[str]] or Corpus): sentences to process, a Corpus sending each worker
+                only the arrays and words of its chunk
+            columns (list): more per-sentence lists passed along with the sentences, e.g. tags
+
+        Returns:
+            dict: index, result for each sentence, in sentence order
+        """
+        chunks = balanced_chunks(document_lengths(sentences), self.processes * self.chunks_per_process)
+        tasks = [(func, idx, take_documents(sentences, idx)) + tuple([c[i] for i in idx] for c in columns) for idx in chunks]
+
+        results = {}
+        for idx, res, metrics in self.pool.imap_unordered(run_chunk, tasks):
+            results.update(zip(idx, res))
+            if metrics is not None:
+                self.metrics.merge(metrics)
+        return {i: results[i] for i in range(len(sentences))}
+
+    def tag(self, sentences):
+        """Tags sentences on the workers.
+
+        With the model's split_documents set, viterbi bigram and trigram models first cut the
+        sentences longer than segment_length into pieces decoded independently (see
+        POSTagger.independent_pieces), which spread over the workers like sentences, so one long
+        document does not keep a single worker busy after the others are done.
+
+        Returns:
+            dict: index, predicted tags for each sentence, in sentence order
+        """
+        model = self.model
+        if not (model.split_documents and model.segment_length > 0 and model.model == 3 and model.kgram <= 3):
+            return self.map(infer_sentences, sentences)
+
+        pieces, resume, owners = model.independent_pieces(sentences)
+        results = self.map(infer_pieces, pieces, resume)
+        predictions = {}
+        for p, d in enumerate(owners.tolist()):
+            if d in predictions: # the shared word is settled by the later piece
+                predictions[d].pop()
+                predictions[d].extend(results[p])
+            else:
+                predictions[d] = results[p]
+        return predictions
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def tag_file(model, sentence_file, output_file, chunksize=50000):
+    """Tags an id,word file and writes the predictions as id,tag rows.
+
+    Documents are decoded in batches of model.batch_size as soon as they have been read,
+    and their rows are written straight away, so memory stays bounded whatever the input size.
+
+    Args:
+        model (POSTagger): trained model
+        sentence_file (str): path to the id,word file to tag
+        output_file (str): path of the id,tag file to write
+        chunksize (int): number of input rows read at once
+    """
+    with open(output_file, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["id", "tag"])  # write the headers first
+
+        def write_batch(batch):
+            predictions = model.inference_batch([words for _, words in batch])
+            for (ids, _), tags in zip(batch, predictions):
+                writer.writerows(zip(ids, tags))
+            csvfile.flush()
+
+        batch = []
+        for doc in stream_documents(sentence_file, chunksize):
+            batch.append(doc)
+            if len(batch) == model.batch_size:
+                write_batch(batch)
+                batch = []
+        if batch:
+            write_batch(batch)
 
 
 class POSTagger():
+    # hyperparameters and arrays written by save; the arrays are loaded back memory-mapped
+    HYPERPARAMETERS = ('k', 'lambda1', 'lambda2', 'lambda3', 'smoothing', 'model', 'kgram', 'beam_k', 'batch_size',
+                       'sparse_trigrams', 'trigram_cache_size', 'oov_cache_size', 'oov_beam',
+                       'segment_cache_size', 'ngram_lambdas', 'segment_length', 'split_documents')
+    ARRAYS = ('unigramsCount', 'bigramsCount', 'trigramsCount', 'trigram_tags', 'trigram_ptr', 'emissionsCount',
+              'ngram_keys', 'ngramsCount', 'context_keys', 'contextCount', 'ngram_weights',
+              'word_tags', 'word_tags_ptr', 'T', 'suffix_tags', 'suffixCount', 'suffix_ptr', 'suffix_theta',
+              'unigrams', 'bigrams', 'trigrams', 'emission_logp', 'log_unigrams', 'log_bigrams', 'log_trigrams')
+
     def __init__(self):
         """Initializes the tagger model parameters and anything else necessary. """
         
         
-        self.unigramsCount = {} # count of each unique unigram 
-        self.bigramsCount = {} # count of each unique bigram
-        self.trigramsCount = {} # count of each unique trigram
-        self.emissionsCount = {} # count of each unique unigram
+        self.unigramsCount = None # count of each tag, indexed by tag id
+        self.bigramsCount = None # count of each bigram, indexed by (tag1 id, tag2 id)
+        self.trigramsCount = None # count of each trigram seen, aligned with trigram_tags
+        self.emissionsCount = None # count of each (word, tag) pair seen, aligned with word_tags
+        self.ngram_keys = self.ngramsCount = None # count of each tag n-gram seen, for kgram > 3 (see get_counts)
+        self.ngram_order = 0 # longest n-grams counted, 0 if none
+        self.suffixes = None # tag counts of each word suffix, for unknown words
+        self.prefixes = None # tag counts of each word prefix, for unknown words
+        self.oov_cache = OrderedDict() # candidate tags and log emissions of recently seen unknown words
+        self.segment_cache = OrderedDict() # tags of recently decoded segments, see inference_segments
+        self.segment_hits = self.segment_misses = 0
+        self.metrics = None # Metrics collected while training and decoding, None to leave instrumentation off
 
         # INPUT HERE
         self.k = 0.1 # add-k smoothing hyperparameter
@@ -103,8 +270,17 @@ class POSTagger():
 
         self.smoothing = False # false is witten (for bigrams) and linear interpolation for trigrams), true is add k
         self.model = 3 # 1 for greedy, 2 for beam, 3 for viterbi
-        self.kgram = 3 # 2 for bigrams, 3 for trigrams   
+        self.kgram = NGRAMM # 2 for bigrams, 3 for trigrams, more for the sparse n-gram model (see ngram_batch)
         self.beam_k = 3 # k parameter as input to beam search
+        self.batch_size = 32 # number of sentences decoded together by inference_batch
+        self.sparse_trigrams = False # true keeps only the trigram counts and computes the rows needed while decoding
+        self.trigram_cache_size = 4096 # number of trigram rows cached when sparse_trigrams is true
+        self.oov_cache_size = 10000 # number of unknown words whose emissions are cached
+        self.oov_beam = 1000 # unknown words only take the tags with an emission at least 1/oov_beam of the best one
+        self.segment_cache_size = 0 # number of decoded segments cached by inference_batch, 0 to decode sentences whole
+        self.ngram_lambdas = None # weights of the 1- to kgram-gram probabilities when kgram > 3, None to set them by deleted interpolation
+        self.segment_length = 0 # viterbi decodes sentences longer than this in segments carrying the lattice state, 0 to decode them whole
+        self.split_documents = False # true lets a TaggerPool decode pieces of a sentence longer than segment_length on different workers
     
     def get_unigrams(self):
         """
@@ -115,10 +291,7 @@ class POSTagger():
         Which is basically the probability of a word being a noun or some other tag. 
         So actually need to count the frequency of a certain tag, and divide by the total no of tags. 
         """
-        ## TODO
-        unigram = np.zeros(len(self.all_tags))
-        for tag in self.tag2idx: 
-            unigram[self.tag2idx[tag]] = self.unigramsCount[tag]/self.N
+        self.unigrams = self.unigramsCount / self.N
 
     def get_bigrams(self):        
         """
@@ -129,93 +302,201 @@ class POSTagger():
         
         So basically this gives you the transition probability of tag2/tag1
         """
-        ## TODO
+        count = self.bigramsCount
+        unigramsCount = self.unigramsCount[:, None]
 
-        tag2idx = self.tag2idx
+        if self.smoothing: # add-k smoothing
+            self.bigrams = (count + self.k) / (unigramsCount + self.k*self.V)
 
-        # initialize the count of each bigram to 0
-        self.bigramsCount = {(tag2idx[tag1], tag2idx[tag2]): 0 for tag1 in tag2idx for tag2 in tag2idx}
-
-        # increment the count of a bigram by 1 each time it appears
-        for sentence in self.data[1]: 
-            for i in range(len(sentence)-1): 
-                tag1 = sentence[i]
-                tag2 = sentence[i+1]
-                self.bigramsCount[(self.tag2idx[tag1], self.tag2idx[tag2])] += 1
-
-        # calculate the transition probability 
-        self.bigrams = np.zeros((len(self.all_tags), len(self.all_tags)))
-        
-        # smoothing
-        for key, count in self.bigramsCount.items(): 
-            tag1 = self.idx2tag[key[0]]
-            tag2 = self.idx2tag[key[1]]
-
-
-            if self.smoothing: # add-k smoothing
-                denominator = self.unigramsCount[tag1] + self.k*self.V
-                self.bigrams[key[0],key[1]] = (count + self.k)/denominator
-            
-            else: # witten-bell smoothing
-                denominator = (len(self.T[tag1]) + self.unigramsCount[tag1])
-                if count == 0: # case where bigram never occurs
-                    self.bigrams[key[0],key[1]] = len(self.T[tag1])/denominator
-                else: 
-                    self.bigrams[key[0],key[1]] = (count)/denominator     
+        else: # witten-bell smoothing
+            T = self.T[:, None]
+            denominator = T + unigramsCount
+            # bigrams that never occur share the mass of the unseen followers
+            self.bigrams = np.where(count == 0, T, count) / denominator
 
     def get_trigrams(self):
         """
         Computes trigrams. 
         Tip. Similar logic to unigrams and bigrams. Store in numpy array. 
+
+        With sparse_trigrams the dense table is never built: the decoders ask log_trigram
+        for the rows they need, which are computed from the sparse counts and cached.
         """
-        tag2idx = self.tag2idx
-        all_tags_len = len(self.all_tags)
+        T = len(self.all_tags)
+        self.reset_trigram_cache()
 
-        # initialize the count of each trigram to 0
-        trigramsCount = {(tag2idx[tag1], tag2idx[tag2], tag2idx[tag3]): 0 for tag1 in tag2idx for tag2 in tag2idx for tag3 in tag2idx}
-        
-        # increment the count of each trigram by 1 when it appears
-        for sentence in self.data[1]: 
-            for i in range(1, len(sentence)):
-                # handle the case where we need two start tags (for the first word after 'O')
-                tag1 = 'O' if i == 1 else sentence[i-2]
-                tag2 = 'O' if i == 1 else sentence[i-1]
-                tag3 = sentence[i]
-                
-                trigram_key = (tag2idx[tag1], tag2idx[tag2], tag2idx[tag3])
-                trigramsCount[trigram_key] += 1
+        if self.sparse_trigrams:
+            self.trigrams = None
+            return
 
-        
-        trigrams = np.zeros((all_tags_len, all_tags_len, all_tags_len))
+        count = np.zeros(T*T*T, dtype=np.int64)
+        histories = np.repeat(np.arange(T*T), np.diff(self.trigram_ptr))
+        count[histories * T + self.trigram_tags] = self.trigramsCount
+        tag1, tag2 = np.indices((T, T))
+        self.trigrams = self.trigram_probabilities(count.reshape(T, T, T), tag1, tag2)
+
+    def trigram_probabilities(self, count, tag1, tag2):
+        """Smooths the trigram counts of some (tag1, tag2) histories.
+
+        Args:
+            count (np.ndarray): (..., T) count of (tag1, tag2, tag3) for every tag3
+            tag1 (np.ndarray): index of tag1, shaped like count without its last axis
+            tag2 (np.ndarray): index of tag2, shaped like count without its last axis
+
+        Returns:
+            np.ndarray: (..., T) Prob(tag3|tag1, tag2) for every tag3
+        """
         bigramsCount = self.bigramsCount
-        unigramsCount = self.unigramsCount
-        idx2tag = self.idx2tag
-        k = self.k
-        V = self.V
-        N = self.N
 
-        for trigram, count in trigramsCount.items(): 
-            tag1_idx, tag2_idx, tag3_idx = trigram
-            tag1, tag2, tag3 = idx2tag[tag1_idx], idx2tag[tag2_idx], idx2tag[tag3_idx]
+        if self.smoothing: # add-k smoothing
+            return (count + self.k) / (bigramsCount[tag1, tag2][..., None] + self.k*self.V)
+
+        # linear interpolation 
+        # hyperparameter values for unigrams, bigrams, and trigrams
+        lambda1, lambda2, lambda3 = self.lambda1, self.lambda2, self.lambda3
+
+        # the required counts/probabilities, broadcast over (..., tag3)
+        bigram_count = bigramsCount[tag2] # count of (tag2, tag3)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            trigram_prob = np.where(bigram_count == 0, 0, count / bigram_count)
+        bigram_prob = bigram_count / self.unigramsCount[tag2][..., None]
+        unigram_prob = self.unigramsCount / self.N
+
+        return lambda3 * trigram_prob + lambda2 * bigram_prob + lambda1 * unigram_prob
+
+    def reset_trigram_cache(self):
+        """Empties the cache of log trigram rows used with sparse_trigrams. """
+        T = len(self.all_tags)
+        size = self.trigram_cache_size if self.sparse_trigrams else 0
+        self.trigram_cache = np.zeros((size, T)) # log Prob(.|tag1, tag2) of the cached histories
+        self.trigram_cache_rows = np.full(size, -1) # history held by each slot, -1 if free
+        self.trigram_cache_used = np.zeros(size, dtype=np.int64) # when each slot was last used
+        self.trigram_slot = np.full(T*T, -1) # slot of each history, -1 if not cached
+        self.trigram_clock = 0
+
+    def log_trigram_rows(self, histories):
+        """Computes log Prob(.|tag1, tag2) from the sparse counts.
 
-            if self.smoothing: # add-k smoothing
-                denominator = bigramsCount[tag1_idx, tag2_idx] + k * V
-                trigrams[tag1_idx, tag2_idx, tag3_idx] = (count + k) / denominator
-            
-            else: # linear interpolation 
-                # hyperparameter values for unigrams, bigrams, and trigrams
-                lambda1, lambda2, lambda3 = self.lambda1, self.lambda2, self.lambda3
+        Args:
+            histories (np.ndarray): (R,) histories tag1*T + tag2
 
-                # Fetch the required counts/probabilities
-                bigram_count = bigramsCount.get((tag2_idx, tag3_idx), 0)
-                trigram_prob = 0 if bigram_count == 0 else count / bigram_count
-                bigram_prob = bigram_count / unigramsCount[tag2]
-                unigram_prob = unigramsCount[tag3] / N
+        Returns:
+            np.ndarray: (R, T) log probability of every tag3 after each history
+        """
+        T = len(self.all_tags)
+        start = self.trigram_ptr[histories]
+        n = self.trigram_ptr[histories+1] - start
+
+        # scatter the CSR row of each history into a dense row of counts
+        count = np.zeros((len(histories), T), dtype=np.int64)
+        entry = np.repeat(start - np.cumsum(n) + n, n) + np.arange(n.sum())
+        count[np.repeat(np.arange(len(histories)), n), self.trigram_tags[entry]] = self.trigramsCount[entry]
+
+        with np.errstate(divide='ignore'):
+            return np.log(self.trigram_probabilities(count, histories // T, histories % T))
 
-                interpolated_prob = lambda3 * trigram_prob + lambda2 * bigram_prob + lambda1 * unigram_prob
-                trigrams[tag1_idx, tag2_idx, tag3_idx] = interpolated_prob
+    def log_trigram(self, tag1, tag2, tag3):
+        """Looks up log Prob(tag3|tag1, tag2) for broadcastable arrays of tag indices.
 
-        self.trigrams = trigrams
+        The decoders read every trigram transition through here. With sparse_trigrams the
+        rows of the histories asked for are taken from a cache of trigram_cache_size rows,
+        computing the missing ones and evicting the least recently used.
+        """
+        if not self.sparse_trigrams:
+            return self.log_trigrams[tag1, tag2, tag3]
+
+        histories = tag1 * len(self.all_tags) + tag2
+        slots = self.trigram_slot[histories]
+
+        missing = slots < 0
+        if missing.any():
+            hits = np.unique(slots[~missing])
+            new = np.unique(histories[missing])
+            if len(hits) + len(new) > self.trigram_cache_size: # too many rows at once for the cache
+                histories, inverse = np.unique(histories, return_inverse=True)
+                return self.log_trigram_rows(histories)[inverse.reshape(slots.shape), tag3]
+
+            # evict the least recently used slots, never the ones holding the hits
+            self.trigram_cache_used[hits] = self.trigram_clock + 1
+            free = np.argpartition(self.trigram_cache_used, len(new)-1)[:len(new)]
+            evicted = self.trigram_cache_rows[free]
+            self.trigram_slot[evicted[evicted >= 0]] = -1
+
+            self.trigram_cache[free] = self.log_trigram_rows(new)
+            self.trigram_cache_rows[free] = new
+            self.trigram_slot[new] = free
+            slots = self.trigram_slot[histories]
+
+        self.trigram_clock += 1
+        self.trigram_cache_used[slots] = self.trigram_clock
+        return self.trigram_cache[slots, tag3]
+
+    def get_ngrams(self):
+        """Builds the order-kgram model used when kgram > 3 from the n-gram counts.
+
+        Its states are the contexts of up to kgram-1 tags seen before a tag in training, plus the
+        empty context as the last backoff state, stored sparsely as sorted codes (see get_counts)
+        with their counts. Prob(tag|context) interpolates the maximum likelihood estimates given
+        every suffix of the context, weighted by ngram_lambdas or, when it is None, by weights
+        found by deleted interpolation (Brants 2000).
+        """
+        if self.ngram_keys is None or not 3 < self.kgram <= self.ngram_order:
+            self.context_keys = self.contextCount = self.ngram_weights = None
+            return
+
+        B = len(self.all_tags) + 1
+        self.context_keys, inverse = np.unique(self.ngram_keys // B, return_inverse=True)
+        self.contextCount = np.bincount(inverse.ravel(), weights=self.ngramsCount).astype(np.int64)
+
+        if self.ngram_lambdas is not None:
+            if len(self.ngram_lambdas) != self.kgram:
+                raise ValueError(f"ngram_lambdas needs {self.kgram} weights, got {len(self.ngram_lambdas)}")
+            self.ngram_weights = np.array(self.ngram_lambdas, dtype=float)
+            return
+
+        # each kgram-gram adds its count to the weight of the order whose estimate, leaving it out,
+        # is the highest
+        powers = B ** np.arange(1, self.kgram+1, dtype=np.int64)
+        kgrams = (self.ngram_keys > powers[:-1].sum()) & (self.ngram_keys <= powers.sum()) # codes of kgram tags
+        suffixes = self.ngram_keys[kgrams][:, None] % powers # their last 1, ..., kgram tags
+        count = lookup_sparse(self.ngram_keys, self.ngramsCount, suffixes) - 1
+        total = lookup_sparse(self.context_keys, self.contextCount, suffixes // B) - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(total > 0, count / total, 0)
+        weights = np.bincount(ratio.argmax(axis=1), weights=self.ngramsCount[kgrams], minlength=self.kgram)
+        self.ngram_weights = weights / weights.sum()
+
+    def ngram_transitions(self, states, tags):
+        """Scores moving from states of the order-kgram model to tags.
+
+        Args:
+            states (np.ndarray): context codes (see get_ngrams)
+            tags (np.ndarray): tag indices, shaped like states
+
+        Returns:
+            log_probs (np.ndarray): log Prob(tag|state)
+            next_states (np.ndarray): code of the longest suffix of (state, tag) seen as a context,
+                0 (the empty context) if there is none
+        """
+        B = len(self.all_tags) + 1
+        powers = B ** np.arange(self.kgram, dtype=np.int64)
+        length = np.searchsorted(np.cumsum(powers), states, side='right') # number of tags in each state
+        used = np.arange(self.kgram) <= length[..., None] # suffixes of the state that exist
+
+        # the last m tags of the state followed by the tag, for m = 0, ..., kgram-1
+        grams = (states[..., None] % powers) * B + tags[..., None] + 1
+        count = lookup_sparse(self.ngram_keys, self.ngramsCount, grams)
+        total = lookup_sparse(self.context_keys, self.contextCount, grams // B)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prob = np.where(used & (total > 0), count / total, 0)
+            log_probs = np.log(prob @ self.ngram_weights)
+
+        # the suffixes of a state are seen whenever it is, so the longest seen one holds all
+        # the context the model can use
+        seen = used[..., :-1] & (lookup_sparse(self.context_keys, self.contextCount, grams[..., :-1]) > 0)
+        longest = seen.shape[-1] - 1 - seen[..., ::-1].argmax(axis=-1)
+        next_states = np.where(seen.any(axis=-1), np.take_along_axis(grams, longest[..., None], axis=-1)[..., 0], 0)
+        return log_probs, next_states
 
     def get_emissions(self):
         """
@@ -224,27 +505,256 @@ class POSTagger():
              Then create a numpy array such that lexical[index(tag), index(word)] = Prob(word|tag) 
 
         Probability of word given a tag, to find this you need to count instances of the word, given a tag
+
+        Emissions are stored sparsely, one row per word (CSR layout, see get_counts):
+        emission_logp holds log Prob(word|tag) for each entry of word_tags.
         """
-        ## TODO
-        data = self.data
-        tag2idx = self.tag2idx
-        idx2tag = self.idx2tag
+        self.emission_logp = np.log(self.emissionsCount / self.unigramsCount[self.word_tags])
 
-        # iterate through every word
-        for i in range(len(data[0])): 
-            for j in range(len(data[0][i])):
-                if (data[0][i][j], tag2idx[data[1][i][j]]) not in self.emissionsCount: 
-                    self.emissionsCount[(data[0][i][j], tag2idx[data[1][i][j]])] = 1
-                else: 
-                    self.emissionsCount[(data[0][i][j], tag2idx[data[1][i][j]])] += 1
+    def get_counts(self, word_ids, tag_ids, position):
+        """Adds the tag n-grams and (word, tag) pairs of a flattened, integer-encoded corpus
+        to the counts, growing the count arrays to the current tagset and vocabulary first.
 
-        self.emissions = np.zeros((len(self.all_words),len(self.all_tags)))
+        Args:
+            word_ids (np.ndarray): word index of every token
+            tag_ids (np.ndarray): tag index of every token
+            position (np.ndarray): position of every token in its sentence
+        """
+        T = len(self.all_tags)
+        prev_T = 0 if self.unigramsCount is None else len(self.unigramsCount) # tagset size before new_data
+        start = self.tag2idx['O']
 
-        # calculate the emission probabilities
-        for key,value in self.emissionsCount.items():
-            denom = self.unigramsCount[idx2tag[key[1]]]
-            self.emissions[self.word2idx[key[0]], key[1]] = value/denom
+        def grow(counts, shape): # zero-pad counts to a larger tagset
+            if counts is None:
+                return np.zeros(shape, dtype=np.int64)
+            return np.pad(counts, [(0, n - m) for n, m in zip(shape, counts.shape)])
 
+        # count of each tag 
+        self.unigramsCount = grow(self.unigramsCount, (T,)) + np.bincount(tag_ids, minlength=T)
+
+        # every pair of consecutive tags in a sentence
+        follows = position[1:] > 0
+        bigram_keys = tag_ids[:-1][follows] * T + tag_ids[1:][follows]
+        self.bigramsCount = grow(self.bigramsCount, (T, T)) + np.bincount(bigram_keys, minlength=T*T).reshape(T, T)
+
+        # every tag after the first one of a sentence, with the two tags before it
+        # (the first word after 'O' gets two start tags)
+        k = np.flatnonzero(position > 0)
+        tag1 = np.where(position[k] > 1, tag_ids[k-2], start)
+        tag2 = np.where(position[k] > 1, tag_ids[k-1], start)
+
+        # count of each trigram seen, stored one row per (tag1, tag2) history (CSR layout): the tags
+        # seen after history r = tag1*T + tag2 are trigram_tags[trigram_ptr[r]:trigram_ptr[r+1]]
+        keys, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if self.trigramsCount is not None: # the trigrams counted so far, keyed with the new tagset
+            histories = np.repeat(np.arange(len(self.trigram_ptr)-1), np.diff(self.trigram_ptr))
+            keys = (histories // prev_T * T + histories % prev_T) * T + self.trigram_tags
+            counts = self.trigramsCount
+        keys, self.trigramsCount = add_sparse_counts(keys, counts, (tag1 * T + tag2) * T + tag_ids[k])
+        self.trigram_tags = (keys % T).astype(np.int32)
+        self.trigram_ptr = np.searchsorted(keys // T, np.arange(T*T+1))
+
+        # with kgram > 3, count every tag n-gram of order 1 to kgram, its tags (t1, ..., tn) written as the
+        # bijective base T+1 number sum((ti+1) * (T+1)**(n-i)), so the code of its context (t1, ..., tn-1)
+        # is code // (T+1) and the code of its last m tags is code % (T+1)**m
+        order = max(self.ngram_order, self.kgram if self.kgram > 3 else 0)
+        if order:
+            if (T+1) ** order >= 2**62:
+                raise ValueError(f"{order}-grams of {T} tags do not fit in 64 bit codes")
+            keys, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            if self.ngramsCount is not None: # the n-grams counted so far, recoded for the new tagset
+                keys, counts = rebase_codes(self.ngram_keys, prev_T+1, T+1), self.ngramsCount
+            code = np.zeros(len(k), dtype=np.int64)
+            new_keys = []
+            for j in range(order): # add the tag j positions back, the start tag before the sentence
+                code = code + (np.where(position[k] >= j, tag_ids[np.maximum(k-j, 0)], start) + 1) * (T+1)**j
+                new_keys.append(code)
+            self.ngram_keys, self.ngramsCount = add_sparse_counts(keys, counts, np.concatenate(new_keys))
+            self.ngram_order = order
+
+        # count of each (word, tag) pair seen, stored one row per word (CSR layout):
+        # the tags seen with word w are word_tags[word_tags_ptr[w]:word_tags_ptr[w+1]] (its ambiguity class)
+        pairs, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if self.emissionsCount is not None: # the pairs counted so far
+            words = np.repeat(np.arange(len(self.word_tags_ptr)-1), np.diff(self.word_tags_ptr))
+            pairs, counts = words * T + self.word_tags, self.emissionsCount
+        pairs, self.emissionsCount = add_sparse_counts(pairs, counts, word_ids * T + tag_ids)
+        self.word_tags = (pairs % T).astype(np.int32)
+        self.word_tags_ptr = np.searchsorted(pairs // T, np.arange(len(self.all_words)+1))
+
+        # number of unique tags appearing after each tag, used for witten bell smoothing
+        self.T = (self.bigramsCount > 0).sum(axis=1)
+
+        self.N = self.unigramsCount.sum()
+
+        self.V = len(self.word2idx)
+
+    def get_affixes(self, word_ids, tag_ids):
+        """Adds new tokens to the suffix and prefix counts used for unknown words, and picks
+        the most common tag again for every suffix and prefix they touch.
+
+        Each distinct (word, tag) pair is counted once with its number of tokens, taking the
+        pairs in order of first occurrence so that ties between tags break as token by token.
+
+        Args:
+            word_ids (np.ndarray): word index of every new token
+            tag_ids (np.ndarray): tag index of every new token
+        """
+        T = len(self.all_tags)
+        pairs, first, counts = np.unique(word_ids * T + tag_ids, return_index=True, return_counts=True)
+        order = np.argsort(first)
+        for pair, count in zip(pairs[order].tolist(), counts[order].tolist()):
+            word, tag = self.all_words[pair // T], self.all_tags[pair % T]
+            # Here, we take the last 3 characters as the suffix
+            self.suffixes[word[-3:]][tag] += count
+            # Here, we take the first 2 characters as the prefix
+            self.prefixes[word[2:]][tag] += count
+
+        # Choose the most common tag for each suffix
+        words = [self.all_words[w] for w in np.unique(word_ids).tolist()]
+        for suffix in set(word[-3:] for word in words):
+            self.suffix_to_tag[suffix] = self.suffixes[suffix].most_common(1)[0][0]
+        for prefix in set(word[2:] for word in words):
+            self.prefix_to_tag[prefix] = self.prefixes[prefix].most_common(1)[0][0]
+
+    def get_suffix_trie(self, word_ids, tag_ids):
+        """Updates the suffix tries used to tag unknown words when TNT_UNK is set (TnT, Brants 2000).
+
+        Unknown words are assumed to behave like the rare words of the training data, so the
+        tries hold the tag counts of every suffix of up to UNK_M characters of the words seen at
+        most UNK_C times, with one trie for capitalized words and one for the others. Each trie
+        node is keyed by its suffix in suffix_ids, the root being the empty suffix, and its tag
+        counts are stored in CSR layout like the emissions: suffix_tags[suffix_ptr[n]:suffix_ptr[n+1]].
+
+        Only the words of the new tokens are visited, once get_counts has counted them: a word
+        still rare adds its new counts to its nodes, a word no longer rare takes its former
+        counts off them, and nodes left without counts are dropped and the others renumbered,
+        so the tries are the same as if they were built from all the data at once.
+
+        Args:
+            word_ids (np.ndarray): word index of every new token
+            tag_ids (np.ndarray): tag index of every new token
+        """
+        T = len(self.all_tags)
+        ptr = self.word_tags_ptr
+
+        # new tokens of each (word, tag) pair and of each word
+        pairs, added = np.unique(word_ids * T + tag_ids, return_counts=True)
+        words, word_added = np.unique(word_ids, return_counts=True)
+
+        # every emission entry of those words, with its count before and after the new tokens
+        n = ptr[words+1] - ptr[words]
+        entry = np.repeat(ptr[words] - np.cumsum(n) + n, n) + np.arange(n.sum())
+        owner = np.repeat(np.arange(len(words)), n)
+        tags = self.word_tags[entry].astype(np.int64)
+        count = self.emissionsCount[entry]
+        old_count = count - lookup_sparse(pairs, added, words[owner] * T + tags)
+        total = np.bincount(owner, weights=count, minlength=len(words))
+        old_total = total - word_added
+        delta = np.where(total[owner] <= UNK_C, count, 0) - np.where(old_total[owner] <= UNK_C, old_count, 0)
+
+        # every (changed word, node) pair, walking down each trie from the root
+        n_nodes = len(self.suffix_ptr) - 1
+        changed = np.unique(owner[delta != 0])
+        left = set(changed[total[changed] > UNK_C].tolist()) # words no longer rare
+        pair_words, pair_nodes, visited = [], [], [] # visited: suffixes of the words no longer rare
+        for i, w in zip(changed.tolist(), words[changed].tolist()):
+            word = self.all_words[w]
+            ids = self.suffix_ids[word[:1].isupper()]
+            for length in range(min(UNK_M, len(word)) + 1):
+                suffix = word[len(word)-length:]
+                node = ids.get(suffix)
+                if node is None:
+                    node = ids[suffix] = n_nodes
+                    n_nodes += 1
+                pair_words.append(i)
+                pair_nodes.append(node)
+            if i in left:
+                visited.extend((ids, word[len(word)-length:]) for length in range(min(UNK_M, len(word)) + 1))
+        pair_words = np.array(pair_words, dtype=np.int64)
+        pair_nodes = np.array(pair_nodes, dtype=np.int64)
+
+        # add the count changes of each word to all of its nodes
+        k = n[pair_words]
+        idx = np.repeat(np.cumsum(n)[pair_words] - n[pair_words] - np.cumsum(k) + k, k) + np.arange(k.sum())
+        old_keys = np.repeat(np.arange(len(self.suffix_ptr)-1), np.diff(self.suffix_ptr)) * T + self.suffix_tags
+        keys, inverse = np.unique(np.concatenate([old_keys, np.repeat(pair_nodes, k) * T + tags[idx]]), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=np.concatenate([self.suffixCount, delta[idx]]), minlength=len(keys))
+        keep = counts > 0
+        keys = keys[keep]
+        self.suffixCount = counts[keep].astype(np.int64)
+        self.suffix_tags = (keys % T).astype(np.int32)
+        nodes = keys // T
+
+        # drop the nodes whose words all stopped being rare, numbering the others from 0 again
+        live = np.unique(nodes)
+        if len(live) < n_nodes:
+            remap = np.full(n_nodes, -1, dtype=np.int64)
+            remap[live] = np.arange(len(live))
+            for ids, suffix in visited:
+                if suffix in ids and remap[ids[suffix]] < 0:
+                    del ids[suffix]
+            remap_list = remap.tolist()
+            self.suffix_ids = [{suffix: remap_list[node] for suffix, node in ids.items()} for ids in self.suffix_ids]
+            nodes, n_nodes = remap[nodes], len(live)
+        self.suffix_ptr = np.searchsorted(nodes, np.arange(n_nodes+1))
+
+        # weight of the shorter suffix when smoothing each trie: the standard deviation of its tag probabilities
+        self.suffix_theta = np.zeros(2)
+        for case, ids in enumerate(self.suffix_ids):
+            if ids:
+                self.suffix_theta[case] = np.std(self.suffix_distribution(ids['']), ddof=1)
+
+        self.oov_cache.clear()
+
+    def suffix_distribution(self, node):
+        """Returns Prob(tag|suffix) for every tag, from the counts of a suffix trie node. """
+        start, end = self.suffix_ptr[node], self.suffix_ptr[node+1]
+        prob = np.zeros(len(self.all_tags))
+        prob[self.suffix_tags[start:end]] = self.suffixCount[start:end] / self.suffixCount[start:end].sum()
+        return prob
+
+    def encode_corpus(self, data):
+        """Maps every word and tag of a tagged corpus to its integer id, adding the words
+        and tags never seen before to the vocabulary and tagset.
+
+        Args:
+            data (tuple(list, list) or Corpus): sentences and their tags, as load_data or load_corpus return them
+
+        Returns:
+            word_ids (np.ndarray): word index of every token
+            tag_ids (np.ndarray): tag index of every token
+            position (np.ndarray): position of every token in its sentence
+        """
+        if isinstance(data, Corpus): # already factorized, only the distinct words and tags are looked up
+            word_codes, new_words = data.word_ids, data.words
+            order = np.argsort(data.tags, kind='stable') # new tags are added in sorted order, as below
+            tag_codes, new_tags = np.argsort(order)[data.tag_ids], data.tags[order]
+            lengths = data.lengths
+        else:
+            words = np.array([word for sentence in data[0] for word in sentence], dtype=object)
+            tags = np.array([t for tag in data[1] for t in tag], dtype=object)
+            word_codes, new_words = pd.factorize(words)
+            tag_codes, new_tags = pd.factorize(tags, sort=True)
+            lengths = np.array([len(sentence) for sentence in data[0]], dtype=np.int64)
+
+        for word in new_words:
+            if word not in self.word2idx:
+                self.word2idx[word] = len(self.all_words)
+                self.idx2word[len(self.all_words)] = word
+                self.all_words.append(word)
+        for tag in new_tags:
+            if tag not in self.tag2idx:
+                self.tag2idx[tag] = len(self.all_tags)
+                self.idx2tag[len(self.all_tags)] = tag
+                self.all_tags.append(tag)
+
+        word_ids = np.array([self.word2idx[word] for word in new_words], dtype=np.int64)[word_codes]
+        tag_ids = np.array([self.tag2idx[tag] for tag in new_tags], dtype=np.int64)[tag_codes]
+
+        # position of every token in its sentence
+        position = np.arange(len(word_ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return word_ids, tag_ids, position
 
     def train(self, data):
         """Trains the model by computing transition and emission probabilities.
@@ -254,90 +764,334 @@ class POSTagger():
             - N-gram models with varying N.
         
         """
-        self.data = data  # data[0] has all the words in the data set
+        self.all_tags = []  # This is the list of all the PoS tags in the dataset. 
+        self.all_words = []  # This is the list of all the words in the dataset. 
+        self.word2idx = {}  # This is basically a dictionary of Word : id 
+        self.idx2word = {}    # And this basically is a dictionary of id: Word
+        self.tag2idx = {}  # This is basically a dictionary of Tag : id 
+        self.idx2tag = {}    # And this basically is a dictionary of id: Tag
 
-        self.all_tags = list(set([t for tag in data[1] for t in tag]))  # This is the list of all the PoS tags in the dataset. 
+        self.unigramsCount = self.bigramsCount = self.trigramsCount = self.emissionsCount = None
 
-        self.all_words = list(set([word for sentence in data[0] for word in sentence]))  # This is the list of all the PoS tags in the dataset. 
-        
-        self.word2idx = {self.all_words[i]:i for i in range(len(self.all_words))}  # This is basically a dictionary of Tag : id 
-        
-        self.idx2word = {v:k for k,v in self.word2idx.items()}    # And this basically is a dictionary of id: Tag
+        # suffix and prefix counts to deal with unknown words, and the most common tag for each
+        self.suffixes = defaultdict(Counter)
+        self.prefixes = defaultdict(Counter)
+        self.suffix_to_tag = {}
+        self.prefix_to_tag = {}
 
-        self.tag2idx = {self.all_tags[i]:i for i in range(len(self.all_tags))}  # This is basically a dictionary of Tag : id 
-        
-        self.idx2tag = {v:k for k,v in self.tag2idx.items()}    # And this basically is a dictionary of id: Tag
+        # suffix tries of the rare words, see get_suffix_trie
+        self.suffix_ids = [{}, {}] # node of each suffix, for lowercase and capitalized words
+        self.suffix_tags, self.suffixCount = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+        self.suffix_ptr = np.zeros(1, dtype=np.int64)
 
-        ## TODO
-        # number of unique tags appearing after each tag
-        self.T = {key: set() for key in self.all_tags} # used for witten bell smoothing
-        
-        for sentence in data[1]:
-            for i in range(len(sentence)-1):
-                self.T[sentence[i]].add(sentence[i+1])
+        self.update(data)
 
-        # count of each tag 
-        for tag in self.all_tags: 
-            self.unigramsCount[tag] = 0
-        for sentence in data[1]: 
-            for tag in sentence: 
-                self.unigramsCount[tag] += 1
+    def update(self, new_data):
+        """Folds newly tagged sentences into a trained model.
 
-        self.N = sum(self.unigramsCount.values())
-        
-        self.V = len(set(self.word2idx.keys()))
-        
+        The new sentences are counted and added to the stored counts, new words and tags are
+        appended to the vocabulary and tagset, and the probability tables are rebuilt from
+        the counts. The cost depends on the size of new_data, the tagset and the vocabulary,
+        never on the data the model was trained on before.
+
+        Args:
+            new_data (tuple(list, list) or Corpus): sentences and their tags
+        """
+        if self.suffixes is None: # model loaded with load, read its suffix and prefix counts
+            self.load_affixes()
+        clock = self.clock('train')
+
+        word_ids, tag_ids, position = self.encode_corpus(new_data)
+        clock.lap('encode')
+        clock.count('train_tokens', len(word_ids))
+
+        self.get_counts(word_ids, tag_ids, position)
+        clock.lap('count')
+
+        self.get_transitions()
+
+        self.get_emissions()
+
+        self.get_suffix_trie(word_ids, tag_ids)
+        clock.lap('tables')
+
+        self.get_affixes(word_ids, tag_ids)
+        clock.lap('affixes')
+
+        self.segment_cache.clear() # decoded with the old tables
+
+    def get_transitions(self):
+        """Rebuilds the unigram, bigram and trigram tables and their logs from the counts.
+
+        These are the only tables that depend on the smoothing hyperparameters.
+        """
         self.get_unigrams()
 
         self.get_bigrams()
 
         self.get_trigrams()
 
-        self.get_emissions()
+        self.get_ngrams()
 
-        # map each bigram to an index, and vice-versa
-        self.bigram2idx = {tup:idx for idx,tup in enumerate(self.bigramsCount.keys())} 
+        self.get_log_probabilities()
 
-        self.idx2bigram = {idx:tup for tup,idx in self.bigram2idx.items()} 
+    def configure(self, **hyperparameters):
+        """Changes hyperparameters of a trained model, e.g. configure(k=0.5, smoothing=True).
 
-        # Build the suffix mapping to deal with unknown words
-        self.suffixes = defaultdict(Counter)
-        for sentence, tag_seq in zip(data[0], data[1]):
-            for word, tag in zip(sentence, tag_seq):
-                # Here, we take the last 3 characters as the suffix
-                self.suffixes[word[-3:]].update([tag])
+        The transition tables are rebuilt from the stored counts, which takes milliseconds,
+        so a sweep over smoothing settings trains the model only once.
 
-        # Build the prefix mapping to deal with unknown words
-        self.prefixes = defaultdict(Counter)
-        for sentence, tag_seq in zip(data[0], data[1]):
-            for word, tag in zip(sentence, tag_seq):
-                # Here, we take the first 2 characters as the prefix
-                self.prefixes[word[2:]].update([tag])
-                
-        # Choose the most common tag for each suffix
-        self.suffix_to_tag = {suffix: tags.most_common(1)[0][0] for suffix, tags in self.suffixes.items()}
-        self.prefix_to_tag = {prefix: tags.most_common(1)[0][0] for prefix, tags in self.prefixes.items()}        
+        Raises:
+            ValueError: if a name is not one of HYPERPARAMETERS
+        """
+        oov_beam = self.oov_beam
+        for name, value in hyperparameters.items():
+            if name not in self.HYPERPARAMETERS:
+                raise ValueError(f"unknown hyperparameter {name}")
+            setattr(self, name, value)
+
+        self.get_transitions()
+        self.segment_cache.clear() # decoded with the old tables
+        if self.oov_beam != oov_beam: # unknown word emissions only depend on the counts otherwise
+            self.oov_cache.clear()
+
+    def clock(self, prefix):
+        """Starts timing the phases of a piece of work into self.metrics (see Metrics.clock),
+        or returns a clock doing nothing when instrumentation is off. """
+        return NULL_CLOCK if self.metrics is None else self.metrics.clock(prefix)
+
+    def get_log_probabilities(self):
+        """
+        Precomputes the log-space transition tables used by the vectorized decoders,
+        so that math.log is never called inside the decoding loops (emissions are stored as logs already).
+        Zero probabilities become -inf.
+        """
+        with np.errstate(divide='ignore'):
+            self.log_unigrams = np.log(self.unigrams)
+            self.log_bigrams = np.log(self.bigrams)
+            self.log_trigrams = None if self.trigrams is None else np.log(self.trigrams)
+
+    def save(self, path):
+        """Writes the trained model to the directory path.
+
+        Every table goes to its own .npy file so that load can memory-map it, and the
+        hyperparameters, tags, vocabulary and unknown-word tables go to JSON index files.
+        """
+        os.makedirs(path, exist_ok=True)
+
+        for name in self.ARRAYS:
+            if getattr(self, name) is not None: # the dense trigram tables are skipped with sparse_trigrams
+                np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+        with open(os.path.join(path, 'vocab.json'), 'w') as f:
+            json.dump(self.all_words, f)
+
+        with open(os.path.join(path, 'unknown.json'), 'w') as f:
+            json.dump({'suffix_to_tag': self.suffix_to_tag, 'prefix_to_tag': self.prefix_to_tag,
+                       'suffix_ids': self.suffix_ids}, f)
+
+        # only needed to keep training the model, so load leaves them on disk until update asks
+        if self.suffixes is None:
+            self.load_affixes()
+        with open(os.path.join(path, 'affixes.json'), 'w') as f:
+            json.dump({'suffixes': self.suffixes, 'prefixes': self.prefixes}, f)
+
+        # written last, so a directory with a model.json always holds a complete model
+        with open(os.path.join(path, 'model.json'), 'w') as f:
+            json.dump({'version': MODEL_VERSION, 'all_tags': self.all_tags, 'N': int(self.N), 'V': int(self.V),
+                       'ngram_order': self.ngram_order,
+                       'hyperparameters': {name: getattr(self, name) for name in self.HYPERPARAMETERS}}, f)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a model written by save.
+
+        The tables are memory-mapped read-only, so loading is immediate and processes that
+        load the same model share its pages through the OS page cache.
+        """
+        with open(os.path.join(path, 'model.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != MODEL_VERSION:
+            raise ValueError(f"{path} holds a version {meta['version']} model, expected version {MODEL_VERSION}")
+
+        model = cls()
+        for name, value in meta['hyperparameters'].items():
+            setattr(model, name, value)
+        model.N, model.V = meta['N'], meta['V']
+        model.ngram_order = meta.get('ngram_order', 0)
+
+        model.all_tags = meta['all_tags']
+        model.tag2idx = {model.all_tags[i]:i for i in range(len(model.all_tags))}
+        model.idx2tag = {v:k for k,v in model.tag2idx.items()}
+
+        with open(os.path.join(path, 'vocab.json')) as f:
+            model.all_words = json.load(f)
+        model.word2idx = {model.all_words[i]:i for i in range(len(model.all_words))}
+        model.idx2word = {v:k for k,v in model.word2idx.items()}
+
+        with open(os.path.join(path, 'unknown.json')) as f:
+            unknown = json.load(f)
+        model.suffix_to_tag = unknown['suffix_to_tag']
+        model.prefix_to_tag = unknown['prefix_to_tag']
+        model.suffix_ids = unknown['suffix_ids']
+        model.affixes_path = os.path.join(path, 'affixes.json')
+
+        for name in cls.ARRAYS:
+            file = os.path.join(path, name + '.npy')
+            setattr(model, name, np.load(file, mmap_mode='r') if os.path.exists(file) else None)
+        model.reset_trigram_cache()
+        return model
+
+    def load_affixes(self):
+        """Reads the suffix and prefix counts of a model loaded with load. """
+        with open(self.affixes_path) as f:
+            affixes = json.load(f)
+        self.suffixes = defaultdict(Counter, {s: Counter(tags) for s, tags in affixes['suffixes'].items()})
+        self.prefixes = defaultdict(Counter, {p: Counter(tags) for p, tags in affixes['prefixes'].items()})
+
+    def unknown_tag(self, word):
+        """Picks a single tag for a word that was never seen in training. """
+        if(word[0].isupper()): # classify the word as a Proper Noun ig the first letter is upper case
+            return "NNP"
+        cur_tag = self.suffix_to_tag.get(word[-3:], None)  # default to none if suffix not in mapping
+        if cur_tag == None:
+            cur_tag = self.prefix_to_tag.get(word[2:], None)  # default to none if suffix not in mapping
+            if(cur_tag == None):
+                cur_tag = "NN" # if none of the above conditions true, default to noun
+        return cur_tag
+
+    def unknown_log_probs(self, word):
+        """Computes the log emission probability of a word never seen in training for every tag,
+        before unknown_emission prunes them (see there): -inf for the tags it cannot take.
+        """
+        case = int(word[:1].isupper())
+        if not self.suffix_ids[case]: # no rare word of this case, use the other trie
+            case = 1 - case
+        ids = self.suffix_ids[case]
+        if TNT_UNK and ids:
+            theta = self.suffix_theta[case]
+            prob = self.suffix_distribution(ids[''])
+            for length in range(1, min(UNK_M, len(word)) + 1):
+                node = ids.get(word[len(word)-length:])
+                if node is None: # no longer suffix can be in the trie either
+                    break
+                prob = (self.suffix_distribution(node) + theta * prob) / (1 + theta)
+            with np.errstate(divide='ignore'):
+                return np.log(prob) - self.log_unigrams
+
+        log_probs = np.full(len(self.all_tags), -math.inf)
+        tag = self.tag2idx[self.unknown_tag(word)]
+        log_probs[tag] = self.log_unigrams[tag]
+        return log_probs
+
+    def unknown_emission(self, word):
+        """Looks up the tags a word never seen in training can take.
+
+        With TNT_UNK the word takes every tag of its longest suffix found in the suffix trie of
+        its case, with Prob(tag|suffix) smoothed down the trie as in TnT:
+            P(t|l[n-i+1..n]) = (P_ML(t|l[n-i+1..n]) + theta P(t|l[n-i+2..n])) / (1 + theta)
+        and the emission Prob(word|tag) taken proportional to P(t|suffix) / P(t). Otherwise it
+        only takes the tag chosen by unknown_tag, with emission Prob(tag).
+
+        The results of the last oov_cache_size words are kept, so every decoder reuses them.
+
+        Returns:
+            tags (np.ndarray): indices of the tags the word can take, in increasing order
+            log_probs (np.ndarray): log emission probability for each of those tags
+        """
+        if word in self.oov_cache:
+            self.oov_cache.move_to_end(word)
+            return self.oov_cache[word]
+
+        log_probs = self.unknown_log_probs(word)
+        if TNT_UNK:
+            # like TnT, drop the tags much less likely than the best one to keep the lattice small
+            tags = np.flatnonzero(log_probs >= log_probs.max() - math.log(self.oov_beam))
+        else:
+            tags = np.flatnonzero(log_probs > -math.inf)
+        log_probs = log_probs[tags]
+
+        self.oov_cache[word] = tags, log_probs
+        if len(self.oov_cache) > self.oov_cache_size:
+            self.oov_cache.popitem(last=False)
+        return tags, log_probs
 
     def sequence_probability(self, sequence, tags):
         """Computes the probability of a tagged sequence given the emission/transition
-        probabilities.
+        probabilities (see sequence_log_probabilities, which does not underflow).
         """
-        ## TODO
-       
-        prob = 1
-        for i in range(1, len(sequence)):
-            # probability of word given the tag
-            if sequence[i] in self.word2idx:
-                q = self.bigrams[self.tag2idx[tags[i-1]], self.tag2idx[tags[i]]]
-                e = self.emissions[self.word2idx[sequence[i]], self.tag2idx[tags[i]]]
-                prob *= q*e
-            else: 
-                continue
-                # FILL THIS IN 
-                # Unknown word prob = 1
+        return math.exp(self.sequence_log_probabilities([sequence], [tags])[0])
+
+    def sequence_log_probabilities(self, sentences, tags=None):
+        """Computes log Prob(words, tags) of a batch of tagged sequences under the transition
+        model of kgram and the emissions, leaving out the start word.
+
+        Every token of the batch is scored at once: the sentences and tags are flattened into
+        integer arrays, the transitions and emissions are gathered for all tokens by fancy
+        indexing and summed per sequence with a bincount. Unknown words are scored with their
+        unpruned emissions (see unknown_log_probs), and a tag the model cannot emit a word with
+        gives the sequence a log probability of -inf.
+
+        Args:
+            sentences (list[list[str]] or Corpus): sentences to score
+            tags (list[list[str]]): tags of each sentence, None to take those of a tagged Corpus
+
+        Returns:
+            np.ndarray: log probability of each tagged sentence
+        """
+        T = len(self.all_tags)
+        start = self.tag2idx['O']
+
+        # flat arrays over every token
+        lengths = document_lengths(sentences)
+        doc = np.repeat(np.arange(len(sentences)), lengths)
+        position = np.arange(len(doc)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        if isinstance(sentences, Corpus): # each distinct word and tag is looked up once
+            word = np.array([self.word2idx.get(w, -1) for w in sentences.words.tolist()], dtype=np.int64)[sentences.word_ids]
+            tag = encode_tags(self.tag2idx, [sentences.tags])[sentences.tag_ids] if tags is None else encode_tags(self.tag2idx, tags)
+        else:
+            words = np.array([w for s in sentences for w in s], dtype=object)
+            word = np.array([self.word2idx.get(w, -1) for w in words], dtype=np.int64)
+            tag = encode_tags(self.tag2idx, tags)
+
+        k = np.flatnonzero((position > 0) & (tag >= 0)) # scored tokens, unknown tags are -inf below
+        t = tag[k]
+
+        def prev(j): # tag j positions back, the start tag before the sentence (as counted in get_counts)
+            return np.where(position[k] >= j, tag[np.maximum(k-j, 0)], start)
+
+        if self.kgram == 2:
+            q = self.log_bigrams[tag[k-1], t]
+        elif self.kgram == 3:
+            first = position[k] == 1
+            q = self.log_trigram(np.where(first, start, tag[k-2]), np.where(first, start, tag[k-1]), t)
+        else:
+            B = T + 1
+            history = sum((prev(j) + 1) * B**(j-1) for j in range(1, self.kgram)) # code of the last kgram-1 tags
+            q, _ = self.ngram_transitions(history, t)
+
+        # emissions of the known words, looked up in the (word, tag) pairs sorted like the CSR arrays
+        pairs = np.repeat(np.arange(len(self.word_tags_ptr)-1), np.diff(self.word_tags_ptr)) * T + self.word_tags
+        known = word[k] >= 0
+        query = np.where(known, word[k], 0) * T + t
+        entry = np.minimum(np.searchsorted(pairs, query), len(pairs)-1)
+        e = np.where(known & (pairs[entry] == query), self.emission_logp[entry], -math.inf)
+
+        # emissions of the unknown words, once per distinct word
+        unknown = np.flatnonzero(~known)
+        if len(unknown):
+            if isinstance(sentences, Corpus):
+                unknown_words = sentences.words[sentences.word_ids[k[unknown]]]
+            else:
+                unknown_words = words[k[unknown]]
+            oov_words, oov_ids = np.unique(unknown_words, return_inverse=True)
+            table = np.array([self.unknown_log_probs(w) for w in oov_words])
+            e[unknown] = table[oov_ids.ravel(), t[unknown]]
+
+        scores = np.bincount(doc[k], weights=q + e, minlength=len(sentences))
+        scores[np.unique(doc[(position > 0) & (tag < 0)])] = -math.inf
+        return scores
 
-        return prob
-    
     def inference(self, sequence):
         """Tags a sequence with part of speech tags.
 
@@ -351,6 +1105,8 @@ class POSTagger():
         # probably won't use this function. 
         ## TODO
 
+        clock = self.clock('inference')
+
         # run the correct model based on the given self.model value
         if self.model == 1: 
             seq = self.greedy(sequence)
@@ -358,449 +1114,865 @@ class POSTagger():
             seq = self.beam(sequence, self.beam_k)
         elif self.model == 3: 
             seq = self.viterbi(sequence)
+
+        clock.documents(1)
         return seq
 
+    def inference_batch(self, sentences, resume=None):
+        """Tags a list of sequences with part of speech tags.
+
+        With segment_cache_size set, the segments of the sentences are decoded separately and
+        cached (see inference_segments), otherwise every sentence is decoded whole. Sentences
+        resuming a document from a lattice state (see viterbi_batch) are never cached.
+
+        Returns:
+            list[list[str]]: predicted tags for each sentence, in the order given
+        """
+        if self.segment_cache_size > 0 and resume is None:
+            return self.inference_segments(sentences)
+        return self.decode_batch(sentences, resume)
+
+    def inference_segments(self, sentences):
+        """Tags a list of sequences, serving the segments already decoded from a cache of
+        segment_cache_size segments.
+
+        Sentences are cut on every word where their viterbi lattice holds a single state (see
+        collapse_points). The tags from such a word on only depend on that state and the words
+        up to the next such word, which make up the segment and its cache key, and a segment
+        missing from the cache is decoded by resuming from its state (see viterbi_batch), so the
+        tags are the same as decoding the sentences whole. The first segment of a sentence is
+        decoded from its start. Cache hits and misses are counted in segment_hits and
+        segment_misses. Only viterbi with bigrams or trigrams is cut, the other decoders decode
+        the sentences whole.
+
+        Returns:
+            list[list[str]]: predicted tags for each sentence, in the order given
+        """
+        if self.model != 3 or self.kgram > 3:
+            return self.decode_batch(sentences)
+        clock = self.clock('inference')
+        cache = self.segment_cache
+        if isinstance(sentences, Corpus):
+            sentences = sentences.sentences()
+
+        # key of every segment: the state it starts from, None at the start, and its words,
+        # every segment after the first starting on the word the one before ends on
+        segments = []
+        for sentence, positions in zip(sentences, word_positions(sentences, range(len(sentences)), SEGMENT_END)):
+            points = self.collapse_points(sentence, positions)
+            cuts = [t for t in sorted(points) if t < len(sentence) - 1]
+            bounds = [0] + cuts + [len(sentence) - 1]
+            states = [None] + [points[t] for t in cuts]
+            segments.append([(state, tuple(sentence[i:j+1])) for state, i, j in zip(states, bounds[:-1], bounds[1:])])
+
+        # decode the segments missing from the cache together, once each
+        found = {}
+        for key in (key for keys in segments for key in keys):
+            if key in found:
+                self.segment_hits += 1
+            elif key in cache:
+                cache.move_to_end(key)
+                found[key] = cache[key]
+                self.segment_hits += 1
+            else:
+                found[key] = None
+                self.segment_misses += 1
+        missing = [key for key, tags in found.items() if tags is None]
+        resume = [None if state is None else self.collapsed_state(state) for state, _ in missing]
+        for key, tags in zip(missing, self.decode_batch([list(words) for _, words in missing], resume, False)):
+            found[key] = cache[key] = tags
+            if len(cache) > self.segment_cache_size:
+                cache.popitem(last=False)
+
+        # the word shared by two segments is tagged by the later one
+        results = []
+        for keys in segments:
+            tags = list(found[keys[0]])
+            for key in keys[1:]:
+                tags.pop()
+                tags.extend(found[key])
+            results.append(tags)
+        clock.documents(len(sentences)) # every sentence waits for the whole call, cached or not
+        return results
+
+    def decode_batch(self, sentences, resume=None, documents=True):
+        """Tags a list of sequences with part of speech tags, decoding each one whole.
+
+        Sentences are sorted by length and cut into buckets of self.batch_size, so each
+        bucket is decoded together with little work wasted on padding. Viterbi with bigrams
+        or trigrams decodes them with viterbi_segments instead, when segment_length is set or
+        sentences resume from a lattice state.
+
+        Args:
+            sentences (list[list[str]] or Corpus): sentences to tag
+            resume (list): state each sentence resumes from, None for a sentence starting a document
+            documents (bool): whether to count the sentences as documents in the metrics, false
+                for the segments of inference_segments, which counts its sentences itself
+
+        Returns:
+            list[list[str]]: predicted tags for each sentence, in the order given
+        """
+        if self.model == 3 and self.kgram <= 3 and (self.segment_length > 0 or resume is not None):
+            return self.viterbi_segments(sentences, resume, documents)
+
+        order = np.argsort(document_lengths(sentences), kind='stable')
+        results = [None] * len(sentences)
+
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start:start+self.batch_size]
+            batch = take_documents(sentences, bucket)
+            clock = self.clock('inference')
+
+            # run the correct model based on the given self.model value
+            if self.kgram > 3:
+                seqs = self.ngram_batch(batch, {1: 1, 2: self.beam_k, 3: None}[self.model])
+            elif self.model == 1:
+                seqs = self.greedy_batch(batch)
+            elif self.model == 2:
+                seqs = [self.beam(batch[b], self.beam_k) for b in range(len(batch))]
+            elif self.model == 3:
+                seqs = self.viterbi_batch(batch)
+
+            if documents: # every sentence of the bucket waits for the whole bucket
+                clock.documents(len(batch))
+
+            for b, seq in zip(bucket, seqs):
+                results[b] = seq
+        return results
+
+    def viterbi_segments(self, sentences, resume=None, documents=True):
+        """Tags a list of sequences with viterbi, decoding each one in segments of at most
+        segment_length words.
+
+        A sentence is cut on the last SEGMENT_END that keeps its segment within segment_length
+        words, or after segment_length words when there is none, and every segment after the
+        first starts on the word the one before ends on. The lattice state at that word is
+        carried over (see viterbi_batch), so the tags are the same as decoding the sentence
+        whole, while the arrays of a batch only span one segment. Round r decodes the r-th
+        segment of every sentence still going, in length-sorted buckets of batch_size.
+
+        Args:
+            sentences (list[list[str]] or Corpus): sentences to tag
+            resume (list): state each sentence resumes from, None for a sentence starting a document
+            documents (bool): whether to count the sentences as documents in the metrics
+
+        Returns:
+            list[list[str]]: predicted tags for each sentence, in the order given
+        """
+        lengths = document_lengths(sentences)
+        size = max(self.segment_length, 2) if self.segment_length > 0 else max(lengths.max(initial=0), 2)
+        states = [None] * len(sentences) if resume is None else list(resume)
+        results = [[] for _ in range(len(sentences))]
+
+        # first word of every segment, then the sentence end
+        bounds = [[0, n] for n in lengths]
+        long = np.flatnonzero(lengths > size)
+        for d, ends in zip(long, word_positions(sentences, long, SEGMENT_END)):
+            cuts = segment_cuts(lengths[d], ends, size)
+            bounds[d] = [0] + cuts + [lengths[d]]
+
+        for r in range(max([len(b) - 1 for b in bounds], default=0)):
+            docs = np.array([d for d, b in enumerate(bounds) if len(b) - 1 > r], dtype=np.int64)
+            starts = np.array([bounds[d][r] for d in docs], dtype=np.int64)
+            ends = np.array([bounds[d][r+1] + (len(bounds[d]) - 2 > r) for d in docs], dtype=np.int64)
+            order = np.argsort(ends - starts, kind='stable')
+
+            for start in range(0, len(order), self.batch_size):
+                bucket = order[start:start+self.batch_size]
+                clock = self.clock('inference')
+                batch = slice_documents(sentences, docs[bucket], starts[bucket], ends[bucket])
+                seqs, finals = self.viterbi_batch(batch, [states[d] for d in docs[bucket]], return_state=True)
+                if documents: # sentences finished here
+                    clock.documents(sum(len(bounds[d]) - 2 == r for d in docs[bucket]))
+
+                for d, seq, state in zip(docs[bucket], seqs, finals):
+                    if r > 0: # the shared word is settled by the later segment
+                        results[d].pop()
+                    results[d].extend(seq)
+                    states[d] = state
+        return results
+
+    def collapse_points(self, words, positions):
+        """Finds the words of a sentence where its viterbi lattice holds a single state.
+
+        A SEGMENT_END word with a single candidate tag leaves a bigram lattice with a single
+        state, and so does a trigram lattice when the word before or after it has a single
+        candidate too. The best path goes through that state whatever came before it, so the
+        words after it can be decoded from it alone (see collapsed_state): the score the state
+        carries adds the same amount to every path.
+
+        Args:
+            words (list[str]): words of the sentence
+            positions (np.ndarray): positions of SEGMENT_END in words
+
+        Returns:
+            dict: (previous tag, tag) index pair of the single state, by position of its word
+        """
+        word2idx, ptr = self.word2idx, self.word_tags_ptr
+
+        def single(word): # only candidate tag of a word, None for unknown or ambiguous words
+            w = word2idx.get(word)
+            if w is None or ptr[w+1] - ptr[w] != 1:
+                return None
+            return int(self.word_tags[ptr[w]])
+
+        points = {}
+        for t in positions.tolist():
+            tag = single(words[t])
+            if tag is None or t == 0: # the first word of a document may take any tag
+                continue
+            if self.kgram == 2:
+                points[t] = (tag, tag)
+            elif t > 1 and single(words[t-1]) is not None:
+                points[t] = (single(words[t-1]), tag)
+            elif t + 1 < len(words) and single(words[t+1]) is not None:
+                points[t+1] = (tag, single(words[t+1]))
+        return points
+
+    def collapsed_state(self, tags):
+        """Returns the lattice state, as viterbi_batch resumes from it, holding only the
+        (previous tag, tag) pair tags found by collapse_points. """
+        return (np.array([tags[0]]), np.array([tags[1]]), np.zeros(1) if self.kgram == 2 else np.zeros((1, 1)))
+
+    def independent_pieces(self, sentences):
+        """Cuts the sentences longer than segment_length into pieces that viterbi decodes
+        independently, so that the pieces of one sentence can go to different workers.
+
+        Sentences are cut where their lattice holds a single state (see collapse_points) into
+        pieces of at most segment_length words, longer only where there is no such word within
+        reach, and every piece after the first starts on the word the one before ends on.
+
+        Returns:
+            pieces (list[list[str]] or Corpus): words of each piece, sentence after sentence
+            resume (list): state each piece resumes from, None for the first piece of a sentence
+            owners (np.ndarray): sentence of each piece
+        """
+        lengths = document_lengths(sentences)
+        size = max(self.segment_length, 2)
+
+        docs, starts, ends, resume = [], [], [], []
+        cuts = {d: [] for d in range(len(sentences))}
+        long = np.flatnonzero(lengths > size)
+        for d, positions in zip(long, word_positions(sentences, long, SEGMENT_END)):
+            points = self.collapse_points(sentences[d], positions) # where a piece may start
+            cuts[d] = segment_cuts(lengths[d], np.array(sorted(points), dtype=np.int64), size, hard=False)
+            cuts[d] = [(t, self.collapsed_state(points[t])) for t in cuts[d]]
+
+        for d in range(len(sentences)):
+            bounds = [(0, None)] + cuts[d] + [(lengths[d] - 1, None)]
+            for (i, state), (j, _) in zip(bounds[:-1], bounds[1:]):
+                docs.append(d)
+                starts.append(i)
+                ends.append(j + 1)
+                resume.append(state)
+        return slice_documents(sentences, docs, starts, ends), resume, np.array(docs, dtype=np.int64)
+
+    def encode(self, sentences):
+        """Maps a batch of sentences, lists of words or a Corpus, to padded integer arrays.
+
+        Returns:
+            word_ids (np.ndarray): (batch, length) word indices, -1 for unknown words and padding
+            oov_ids (np.ndarray): (batch, length) row of each unknown word in oov
+            lengths (np.ndarray): (batch,) number of words in each sentence
+            oov (tuple(np.ndarray, np.ndarray)): (U, K) candidate tags and log emissions of the
+                U distinct unknown words of the batch (see unknown_emission), padded with -inf
+        """
+        word2idx = self.word2idx
+        clock = self.clock('encode')
+
+        if isinstance(sentences, Corpus): # each distinct word is looked up once
+            lengths = sentences.lengths
+            word_ids = np.full((len(sentences), lengths.max()), -1)
+            oov_ids = np.zeros((len(sentences), lengths.max()), dtype=np.int64)
+            doc = np.repeat(np.arange(len(sentences)), lengths)
+            position = np.arange(len(doc)) - np.repeat(sentences.offsets[:-1], lengths)
+
+            vocab = np.array([word2idx.get(w, -1) for w in sentences.words.tolist()], dtype=np.int64)
+            word_ids[doc, position] = vocab[sentences.word_ids]
+            unknown = np.flatnonzero(vocab[sentences.word_ids] < 0)
+            unknown_words, rows = np.unique(sentences.word_ids[unknown], return_inverse=True)
+            oov_ids[doc[unknown], position[unknown]] = rows.ravel()
+            oov_words = sentences.words[unknown_words].tolist()
+        else:
+            lengths = np.array([len(s) for s in sentences])
+            word_ids = np.full((len(sentences), lengths.max()), -1)
+            oov_ids = np.zeros((len(sentences), lengths.max()), dtype=np.int64)
+
+            oov_words = {} # row of each distinct unknown word
+            for b, sentence in enumerate(sentences):
+                for i, word in enumerate(sentence):
+                    if word in word2idx:
+                        word_ids[b, i] = word2idx[word]
+                    else:
+                        oov_ids[b, i] = oov_words.setdefault(word, len(oov_words))
+        clock.lap('lookup')
+        clock.count('tokens', lengths.sum())
+        clock.count('oov_tokens', (word_ids < 0).sum() - (word_ids.size - lengths.sum())) # padding is -1 too
+
+        rows = [self.unknown_emission(word) for word in oov_words]
+        width = max([len(tags) for tags, _ in rows], default=1)
+        oov_cands = np.zeros((max(len(rows), 1), width), dtype=np.int64) # never empty, so it can always be indexed
+        oov_e = np.full((max(len(rows), 1), width), -math.inf)
+        for u, (tags, log_probs) in enumerate(rows):
+            oov_cands[u, :len(tags)] = tags
+            oov_e[u, :len(tags)] = log_probs
+        clock.lap('unknown_words')
+        return word_ids, oov_ids, lengths, (oov_cands, oov_e)
+
+    def candidate_tags(self, word_ids, oov_ids, oov):
+        """Looks up the tags that the words at one position of a batch can take.
+
+        Known words can only take the tags they were seen with in training (their ambiguity
+        class), unknown words the tags given by unknown_emission.
+
+        Args:
+            word_ids (np.ndarray): (batch,) word indices, -1 for unknown words
+            oov_ids (np.ndarray): (batch,) row of each unknown word in oov
+            oov (tuple(np.ndarray, np.ndarray)): unknown word tags and emissions, from encode
+
+        Returns:
+            cands (np.ndarray): (batch, K) candidate tag indices in increasing order, padded with 0
+            e (np.ndarray): (batch, K) log emission probability of each candidate, -inf for padding
+        """
+        oov_cands, oov_e = oov
+        known = word_ids >= 0
+        w = np.where(known, word_ids, 0)
+        start = self.word_tags_ptr[w]
+        count = np.where(known, self.word_tags_ptr[w+1] - start, (oov_e[oov_ids] > -math.inf).sum(axis=1))
+
+        slot = np.arange(count.max(initial=1))
+        valid = slot < count[:, None]
+        entry = np.minimum(start[:, None] + slot, len(self.word_tags)-1) # position in the CSR arrays
+        cands = np.where(valid, self.word_tags[entry], 0)
+        e = np.where(valid, self.emission_logp[entry], -math.inf)
+
+        K = min(len(slot), oov_cands.shape[1])
+        unknown = np.flatnonzero(~known)
+        cands[unknown, :K] = oov_cands[oov_ids[unknown], :K]
+        e[unknown, :K] = oov_e[oov_ids[unknown], :K]
+        return cands, e
+
+    def posteriors(self, sentences):
+        """Computes how likely every tag is at every word, and how likely each sentence is.
+
+        Sentences are sorted by length and run through forward_backward_batch in buckets of
+        self.batch_size, like decode_batch.
+
+        Returns:
+            list[np.ndarray]: (length, T) Prob(tag at word i|sentence) of each sentence, by tag index
+            np.ndarray: log Prob(sentence) of each sentence, summed over all its taggings
+        """
+        order = np.argsort(document_lengths(sentences), kind='stable')
+        posteriors = [None] * len(sentences)
+        log_likelihoods = np.zeros(len(sentences))
+
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start:start+self.batch_size]
+            posterior, log_likelihood = self.forward_backward_batch(take_documents(sentences, bucket))
+            for b, p in zip(bucket, posterior):
+                posteriors[b] = p
+            log_likelihoods[bucket] = log_likelihood
+        return posteriors, log_likelihoods
+
+    def forward_backward_batch(self, sentences):
+        """ Computes tag posteriors for a batch of sequences
+
+        Implements the forward-backward algorithm in log space over the lattice of viterbi_batch:
+        the candidate tags of each word (see candidate_tags), scored with the same transition and
+        emission tables, with states over the current tag for bigrams and over (prev, cur) tag
+        pairs for trigrams. The start word takes the start tag, and like the counts, the first
+        trigram has two start tags before it. Each step of both recurrences runs for the whole
+        batch at once, so a pass costs about two viterbi passes.
+
+        Returns:
+            list[np.ndarray]: (length, T) Prob(tag at word i|sentence) of each sentence, by tag index
+            np.ndarray: log Prob(sentence) of each sentence, summed over all its taggings
+        """
+        if self.kgram not in (2, 3):
+            raise ValueError(f"forward-backward runs on bigram and trigram models, not kgram = {self.kgram}")
+
+        word_ids, oov_ids, lengths, oov = self.encode(sentences)
+        n, L = word_ids.shape
+        T = len(self.all_tags)
+        start = self.tag2idx['O']
+        clock = self.clock('forward_backward')
+
+        # candidate tags and log emissions of every word, the start word only taking the start tag
+        cands, e = [np.full((n, 1), start)], [np.zeros((n, 1))]
+        for i in range(1, L):
+            c, em = self.candidate_tags(word_ids[:, i], oov_ids[:, i], oov)
+            cands.append(c)
+            e.append(em)
+
+        def step(i): # log Prob(candidate at i|state at i-1) + log emission: (n, K_i-1, K_i) or (n, K_i-2, K_i-1, K_i)
+            if self.kgram == 2:
+                q = self.log_bigrams[cands[i-1][:, :, None], cands[i][:, None, :]]
+                return q + e[i][:, None, :]
+            c2 = cands[i-2] if i > 1 else cands[0]
+            q = self.log_trigram(c2[:, :, None, None], cands[i-1][:, None, :, None], cands[i][:, None, None, :])
+            return q + e[i][:, None, None, :]
+
+        # forward: alpha[i] is log Prob(words up to i, state at i)
+        alpha = [np.zeros((n, 1)) if self.kgram == 2 else np.zeros((n, 1, 1))]
+        log_likelihood = np.zeros(n)
+        states = 0
+        for i in range(1, L):
+            prob = alpha[i-1][..., None] + step(i)
+            alpha.append(logsumexp(prob, axis=1))
+            states += prob.size
+            ending = lengths == i+1
+            log_likelihood[ending] = logsumexp(alpha[i][ending], axis=tuple(range(1, alpha[i].ndim)))
+        clock.lap('forward')
+        clock.count('states_expanded', 2 * states)
+
+        # backward: beta[i] is log Prob(words after i|state at i), 0 at the last word of each sentence,
+        # and the posterior of each candidate at i sums alpha * beta over the states ending with it
+        posterior = np.zeros((n, L, T+1)) # padding candidates go to the extra last column
+        posterior[:, 0, start] = 1
+        beta = np.zeros_like(alpha[L-1])
+        for i in range(L-1, 0, -1):
+            beta[lengths == i+1] = 0
+            gamma = alpha[i] + beta - log_likelihood.reshape((n,) + (1,) * (beta.ndim-1))
+            if self.kgram == 3:
+                gamma = logsumexp(gamma, axis=1)
+            live = np.flatnonzero(lengths > i)
+            c = np.where(e[i][live] > -math.inf, cands[i][live], T)
+            posterior[live[:, None], i, c] = np.exp(gamma[live])
+            beta = logsumexp(step(i) + beta[:, None], axis=-1)
+        clock.lap('backward')
+
+        return [posterior[b, :m, :T] for b, m in enumerate(lengths)], log_likelihood
+
     def greedy (self, sequence):
         """ Tags a sequence with PoS tags
 
         Implements Greedy decoding"""
-        ## TODO 
-        
-        # bigram case
-        if self.kgram == 2: 
-            
-            # set the starting tag to 'O'
-            prev = 'O'
-            tagSeq = ['O']
-
-            for word in sequence[1:]: # iterate through every word after the start word
-        
-                maxi = 0
-                maxTag = ''
-
-                if word in self.word2idx: # known word
-
-                    # iterate through all tags, and identify the previous tag that leads to the maximum bigram transition probability
-                    for tag2 in self.all_tags: 
-                        q = self.bigrams[self.tag2idx[prev], self.tag2idx[tag2]] # calculate bigram transition probability
-                        e = self.emissions[self.word2idx[word], self.tag2idx[tag2]]
-                        if q*e > maxi: 
-                            maxTag = tag2
-                            maxi = q*e
-                    prev = maxTag
-                    tagSeq.append(maxTag)
-
-                else: # deal with unknown words 
-                    if(word[0].isupper()): # classify the word as a Proper Noun ig the first letter is upper case
-                        cur_tag = "NNP"
-                    else: 
-                        cur_tag = self.suffix_to_tag.get(word[-3:], None)  # default to none if suffix not in mapping
-                        
-                        if cur_tag == None: 
-                            cur_tag = self.prefix_to_tag.get(word[2:], None)  # default to none if suffix not in mapping
-                            if(cur_tag == None):
-                                cur_tag = "NN" # if none of the above conditions true, default to noun
-
-                    tagSeq.append(cur_tag)
-            return tagSeq
-        
-        elif self.kgram == 3: # trigram case
-
-            # set both prev tags to 'O' to get the first transition probability
-            prev1 = 'O' # prev1 is the tag right before the current tag
-            prev2 = 'O' # prev2 is the tag 2 tags back from the current tag
-
-            tagSeq = ['O']
-            
-            for word in sequence[1:]:  # iterate through all words in the sequence after the first one
-                maxi = 0
-                maxTag = ''
-
-                if word in self.word2idx: # known case
-                    for tag2 in self.all_tags: 
-                        q = self.trigrams[self.tag2idx[prev2], self.tag2idx[prev1], self.tag2idx[tag2]] # calculate trigram probability
-                        e = self.emissions[self.word2idx[word], self.tag2idx[tag2]]
-                        if q*e > maxi: 
-                            maxTag = tag2
-                            maxi = q*e
-                    prev2 = prev1
-                    prev1 = maxTag
-                    tagSeq.append(maxTag)
-                
-                else: # unknown case 
-                    if(word[0].isupper()): # classify the word as a Proper Noun ig the first letter is upper case
-                        cur_tag = "NNP"
-                    else: 
-                        cur_tag = self.suffix_to_tag.get(word[-3:], None)  # default to none if suffix not in mapping
-                        
-                        if cur_tag == None: 
-                            cur_tag = self.prefix_to_tag.get(word[2:], None)  # default to none if suffix not in mapping
-                            if(cur_tag == None):
-                                cur_tag = "NN" # if none of the above conditions true, default to noun
-
-                    tagSeq.append(cur_tag)
-            return tagSeq
+        if self.kgram > 3:
+            return self.ngram_batch([sequence], 1)[0]
+        return self.greedy_batch([sequence])[0]
+
+    def greedy_batch(self, sentences):
+        """ Tags a batch of sequences with PoS tags
+
+        Implements Greedy decoding, taking each step for the whole batch at once"""
+        word_ids, oov_ids, lengths, oov = self.encode(sentences)
+        B, L = word_ids.shape
+        log_bigrams = self.log_bigrams
+        heuristic = (word_ids < 0) & (not TNT_UNK) # unknown words given a single tag by unknown_tag
+
+        # set the starting tags to 'O'
+        start = self.tag2idx['O']
+        prev1 = np.full(B, start) # prev1 is the tag right before the current tag
+        prev2 = np.full(B, start) # prev2 is the tag 2 tags back from the current tag
+
+        tags = np.full((B, L), start)
+        clock = self.clock('greedy')
+        states = 0 # number of (previous tags, tag) transitions scored
+
+        for i in range(1, L): # iterate through every word after the start word
+            active = np.nonzero(lengths > i)[0]
+            known = active[~heuristic[active, i]]
+            unknown = active[heuristic[active, i]]
+
+            # known words take the candidate tag with the maximum transition * emission probability
+            cands, e = self.candidate_tags(word_ids[known, i], oov_ids[known, i], oov)
+            if self.kgram == 2:
+                q = log_bigrams[prev1[known][:, None], cands]
+            elif self.kgram == 3:
+                q = self.log_trigram(prev2[known][:, None], prev1[known][:, None], cands)
+            best = np.take_along_axis(cands, (q + e).argmax(axis=1)[:, None], axis=1)[:, 0]
+            states += q.size
+
+            tags[known, i] = best
+            prev2[known] = prev1[known]
+            prev1[known] = best
+
+            # unknown words take their heuristic tag, without moving the previous tags on
+            tags[unknown, i] = oov[0][oov_ids[unknown, i], 0]
+        clock.lap('search')
+        clock.count('states_expanded', states)
 
-    def beam(self, sequence, k):
-        tag2idx = self.tag2idx
-        word2idx = self.word2idx
-        all_tags = self.all_tags
-        bigrams = self.bigrams
-        trigrams = self.trigrams
-        emissions = self.emissions
-        unigramsCount = self.unigramsCount
-        N = self.N
-    
-        if self.kgram == 2: # bigram case
-
-            # store the overall most probable k sequences and their probabilities
-            top_k_seq = [['O'] for _ in range(k)]
-            top_k_prob = [0] * k
-
-            for word in sequence[1:-1]:
-
-                if word in word2idx: # known case
-                    word_idx = word2idx[word]
-
-                    # dict to store probabilities, and their respective sequences, and parent sequence indices
-                    cur_k_seq = {}
-                    
-                    # set to store the current top k sequences that are in the above dict 
-                    cur_k_seq_set = set()
-
-                    # iterate through the current top k sequences
-                    for i, parent in enumerate(top_k_seq):
-
-                        parent_prob = top_k_prob[i]
-                        last_tag_idx = tag2idx[parent[-1]]
-
-                        for tag in all_tags:
-                            tag_idx = tag2idx[tag]
-                            q = bigrams[last_tag_idx, tag_idx]
-                            e = emissions[word_idx, tag_idx]
-                            
-                            if e == 0: continue
-                            
-                            # use log prob to avoid zeroing out of probabilities 
-                            prob = log(q) + log(e) + parent_prob
-                            new_seq = parent + [tag]
-
-                            # the set ensures we do not add in a duplicate sequence
-                            if tuple(new_seq) not in cur_k_seq_set:
-
-                                # add in a sequence without checking if we have under k sequences
-                                if len(cur_k_seq_set) < k:
-                                    cur_k_seq_set.add(tuple(new_seq))
-                                    cur_k_seq[prob] = new_seq
-
-                                else: # replace mininum probability sequence with higher probability sequence
-                                    minProb = min(cur_k_seq.keys())
-                                    if prob > minProb:
-                                        remove_seq = cur_k_seq.pop(minProb)
-                                        cur_k_seq_set.remove(tuple(remove_seq))
-                                        cur_k_seq_set.add(tuple(new_seq))
-                                        cur_k_seq[prob] = new_seq
-
-                    top_k_prob = sorted(cur_k_seq.keys(), reverse=True)[:k]
-                    top_k_seq = [cur_k_seq[p] for p in top_k_prob]
-
-                else:
-                    for i, seq in enumerate(top_k_seq):
-                        if(word[0].isupper()): # classify the word as a Proper Noun ig the first letter is upper case
-                            cur_tag = "NNP"
-                        else: 
-                            cur_tag = self.suffix_to_tag.get(word[-3:], None)  # default to none if suffix not in mapping
-                            
-                            if cur_tag == None: 
-                                cur_tag = self.prefix_to_tag.get(word[2:], None)  # default to none if suffix not in mapping
-                                if(cur_tag == None):
-                                    cur_tag = "NN" # if none of the above conditions true, default to noun
-
-                        seq.append(cur_tag)
-                        
-                        last_tag_idx = tag2idx[seq[-1]]
-                        cur_tag_idx = tag2idx[cur_tag]
-                        q = bigrams[last_tag_idx, cur_tag_idx]
-                        e = unigramsCount[cur_tag] / N
-                        top_k_prob[i] += log(q) + log(e)
-
-            # return the highest probability sequence from the top k identified
-            sol = top_k_seq[0]
-            sol.append('.')
-            return sol
+        idx2tag = self.idx2tag
+        seqs = [[idx2tag[t] for t in tags[b, :n]] for b, n in enumerate(lengths)]
+        clock.lap('output')
+        return seqs
 
-        elif self.kgram == 3:
+    def beam(self, sequence, k):
+        """ Tags a sequence with PoS tags
 
-            # store the overall most probable k sequences and their probabilities
-            top_k_seq = [['O', 'O'] for _ in range(k)]
-            top_k_prob = [0] * k
-
-            for word in sequence[1:-1]:
-
-                if word in word2idx: # known case
-                    word_idx = word2idx[word]
-
-                    # dict to store probabilities, and their respective sequences, and parent sequence indices
-                    cur_k_seq = {}
-                    
-                    # set to store the current top k sequences that are in the above dict 
-                    cur_k_seq_set = set()
-
-                    # iterate through the current top k sequences
-                    for i, parent in enumerate(top_k_seq):
-                        parent_prob = top_k_prob[i]
-                        last_two_tags_idx = (tag2idx[parent[-2]], tag2idx[parent[-1]])
-
-                        for tag in all_tags:
-                            tag_idx = tag2idx[tag]
-                            q = trigrams[last_two_tags_idx + (tag_idx,)]
-                            e = emissions[word_idx, tag_idx]
-
-                            if e == 0: continue
-                            
-                            # use log prob to avoid zeroing out of probabilities 
-                            prob = log(q) + log(e) + parent_prob
-                            new_seq = parent + [tag]
-
-                            # the set ensures we do not add in a duplicate sequence
-                            if tuple(new_seq) not in cur_k_seq_set:
-                                
-                                # add in a sequence without checking if we have under k sequences
-                                if len(cur_k_seq_set) < k:
-                                    cur_k_seq_set.add(tuple(new_seq))
-                                    cur_k_seq[prob] = new_seq
-
-                                else: # replace mininum probability sequence with higher probability sequence
-                                    minProb = min(cur_k_seq.keys())
-                                    if prob > minProb:
-                                        remove_seq = cur_k_seq.pop(minProb)
-                                        cur_k_seq_set.remove(tuple(remove_seq))
-                                        cur_k_seq_set.add(tuple(new_seq))
-                                        cur_k_seq[prob] = new_seq
-
-                    top_k_prob = sorted(cur_k_seq.keys(), reverse=True)[:k]
-                    top_k_seq = [cur_k_seq[p] for p in top_k_prob]
-
-                else:
-                    for i, seq in enumerate(top_k_seq):
-                        if(word[0].isupper()): # classify the word as a Proper Noun ig the first letter is upper case
-                            cur_tag = "NNP"
-                        else: 
-                            cur_tag = self.suffix_to_tag.get(word[-3:], None)  # default to none if suffix not in mapping
-                            
-                            if cur_tag == None: 
-                                cur_tag = self.prefix_to_tag.get(word[2:], None)  # default to none if suffix not in mapping
-                                if(cur_tag == None):
-                                    cur_tag = "NN" # if none of the above conditions true, default to noun
-
-                        seq.append(cur_tag)
-                        
-                        last_two_tags_idx = (tag2idx[seq[-2]], tag2idx[seq[-1]])
-                        cur_tag_idx = tag2idx[cur_tag]
-                        q = trigrams[last_two_tags_idx + (cur_tag_idx,)]
-                        e = unigramsCount[cur_tag] / N
-                        top_k_prob[i] += log(q) + log(e)
-
-            # return the highest probability sequence from the top k identified
-            sol = top_k_seq[0]
-            sol.append('.')
-            sol.pop(0)
-            return sol  
+        Implements beam search. The beam is held in arrays (score and last two tags of each
+        hypothesis), and every word stores a back pointer from each hypothesis to its parent
+        in the previous beam, so the best path is only rebuilt once at the end."""
+        if self.kgram > 3:
+            return self.ngram_batch([sequence], k)[0]
+        word_ids, oov_ids, lengths, oov = self.encode([sequence])
+        n = len(sequence)
+        log_bigrams = self.log_bigrams
+
+        # the beam starts with a single hypothesis: the start tag 'O'
+        start = self.tag2idx['O']
+        scores = np.zeros(1)
+        prev1 = np.array([start]) # last tag of each hypothesis
+        prev2 = np.array([start]) # tag before that
+
+        parents = np.zeros((n, k), dtype=np.int64) # back pointers into the previous beam
+        beam_tags = np.full((n, k), start) # tag chosen by each hypothesis at each word
+        clock = self.clock('beam')
+        states = 0 # number of (hypothesis, tag) extensions scored
+
+        for i in range(1, n):
+            cands, e = self.candidate_tags(word_ids[:, i], oov_ids[:, i], oov)
+            cands, e = cands[0], e[0]
+
+            # score every (hypothesis, candidate tag) extension at once
+            if self.kgram == 2:
+                q = log_bigrams[prev1[:, None], cands]
+            elif self.kgram == 3:
+                q = self.log_trigram(prev2[:, None], prev1[:, None], cands)
+            total = (scores[:, None] + q + e).ravel()
+            states += total.size
+
+            # keep the k best extensions, best first
+            top = np.arange(len(total)) if len(total) <= k else np.argpartition(-total, k-1)[:k]
+            top = top[np.argsort(-total[top], kind='stable')]
+
+            parent = top // len(cands)
+            scores = total[top]
+            prev2 = prev1[parent]
+            prev1 = cands[top % len(cands)]
+
+            parents[i, :len(top)] = parent
+            beam_tags[i, :len(top)] = prev1
+        clock.lap('search')
+        clock.count('states_expanded', states)
+
+        # follow the back pointers from the best hypothesis in the final beam
+        idx2tag = self.idx2tag
+        seq = ['O'] * n
+        h = 0
+        for i in range(n-1, 0, -1):
+            seq[i] = idx2tag[beam_tags[i, h]]
+            h = parents[i, h]
+        clock.lap('backtrack')
+        return seq
 
     def viterbi (self, sequence):
         """ Tags a sequence with PoS tags
 
         Implements viterbi decoding"""
+        if self.kgram > 3:
+            return self.ngram_batch([sequence])[0]
+        return self.viterbi_batch([sequence])[0]
 
-        # TODO
+    def viterbi_batch(self, sentences, resume=None, return_state=False):
+        """ Tags a batch of sequences with PoS tags
 
-        len_bigramsCount = len(self.bigramsCount.keys())
-        log = math.log
-        tag2idx = self.tag2idx
-        bigram2idx = self.bigram2idx
+        Implements viterbi decoding, running each step of the recurrence for the whole
+        batch at once. Sentences shorter than the longest one stop updating once they end.
+
+        The lattice only holds the candidate tags of each word (see candidate_tags), so a
+        trigram step costs K^3 for ambiguity classes of size K rather than T^3.
+
+        A sentence can also continue a document decoded up to its first word: its lattice then
+        starts from the state at that word, a (cands2, cands1, pi) tuple holding the candidates
+        of the word before it, its own candidates and the scores of the lattice over them, as
+        returned with return_state. Its tags start with the one of that first word, which is
+        only settled by the word after it.
+
+        Args:
+            sentences (list[list[str]] or Corpus): sentences to tag
+            resume (list): state each sentence resumes from, None for a sentence starting a document
+            return_state (bool): whether to also return the state at the last word of each sentence
+
+        Returns:
+            list[list[str]]: predicted tags for each sentence, and the list of states if return_state
+        """
+        word_ids, oov_ids, lengths, oov = self.encode(sentences)
+        B, L = word_ids.shape
+        T = len(self.all_tags)
+        log_bigrams = self.log_bigrams
+        heuristic = (word_ids < 0) & (not TNT_UNK) # unknown words given a single tag by unknown_tag
+        if resume is None:
+            resume = [None] * B
+        fresh = np.array([state is None for state in resume])
+
+        # best (prev, cur) tag pair at every position, read back into the tag sequence at the end
+        prev_tags = np.zeros((B, L), dtype=np.int64) # back pointers
+        cur_tags = np.zeros((B, L), dtype=np.int64)
+
+        # the start word and the tag before it may take any tag, resumed sentences take their
+        # state, padded with tag 0 and -inf scores to the widest one
+        width2 = max([T if state is None else len(state[0]) for state in resume])
+        width1 = max([T if state is None else len(state[1]) for state in resume])
+        cands1 = np.zeros((B, width1), dtype=np.int64) # candidates of the previous word
+        cands2 = np.zeros((B, width2), dtype=np.int64) # candidates of the word before that
+        if fresh.any():
+            cands1[fresh] = cands2[fresh] = np.arange(T)
+
+        if self.kgram == 2: # bigram case, lattice over the current tag
+            pi = np.zeros((B, width1)) # set initial probabilities to 0 (log space)
+        elif self.kgram == 3: # trigram case, lattice over (prev, cur) tag pairs
+            pi = np.zeros((B, width2, width1))
+        pi[~fresh] = -math.inf
+        for b in np.flatnonzero(~fresh):
+            c2, c1, p = resume[b]
+            cands2[b, :len(c2)] = c2
+            cands1[b, :len(c1)] = c1
+            pi[(b,) + tuple(slice(n) for n in p.shape)] = p
+            cur_tags[b, 0] = c1[np.unravel_index(p.argmax(), p.shape)[-1]]
+        final = list(resume) # state at the last word of each sentence
+        clock = self.clock('viterbi')
+        states = 0 # number of lattice transitions scored
+
+        for i in range(1, L): # iterate through all words after the first
+            active = np.nonzero(lengths > i)[0]
+            known = active[~heuristic[active, i]]
+            unknown = active[heuristic[active, i]]
+
+            cands, e = self.candidate_tags(word_ids[:, i], oov_ids[:, i], oov)
+            K = cands.shape[1]
+            new_pi = np.full((B, K) if self.kgram == 2 else (B, cands1.shape[1], K), -math.inf)
+
+            # unknown words given a heuristic tag only have it, in the first slot
+            j = cands[unknown, 0]
+            e_unknown = e[unknown, 0]
+
+            if self.kgram == 2:
+                back = np.zeros((B, K), dtype=np.int64)
+
+                # known words: bigram transition from every previous candidate to every current candidate
+                c1, c = cands1[known], cands[known]
+                prob = log_bigrams[c1[:, :, None], c[:, None, :]] + e[known][:, None, :] + pi[known][:, :, None]
+                states += prob.size
+                new_pi[known] = prob.max(axis=1)
+                back[known] = np.take_along_axis(c1, prob.argmax(axis=1), axis=1)
+
+                # unknown words
+                c1 = cands1[unknown]
+                prob = log_bigrams[c1, j[:, None]] + e_unknown[:, None] + pi[unknown]
+                states += prob.size
+                new_pi[unknown, 0] = prob.max(axis=1)
+                back[unknown, 0] = c1[np.arange(len(unknown)), prob.argmax(axis=1)]
+
+                best = new_pi[active].argmax(axis=1)
+                cur_tags[active, i] = cands[active, best]
+                prev_tags[active, i] = back[active, best]
+
+            elif self.kgram == 3:
+                if i == 1: # if first word of a document, find bigram probability as only 1 start tag
+                    first, known = known[fresh[known]], known[~fresh[known]]
+                    new_pi[first] = (log_bigrams[0, cands[first]] + e[first])[:, None, :]
+                    states += cands[first].size
+                if len(known): # trigram transition for every (prev2, prev, cur) at once, then max out prev2
+                    c2, c1, c = cands2[known], cands1[known], cands[known]
+                    q = self.log_trigram(c2[:, :, None, None], c1[:, None, :, None], c[:, None, None, :])
+                    new_pi[known] = (q + e[known][:, None, None, :] + pi[known][:, :, :, None]).max(axis=1)
+                    states += q.size
+
+                # unknown words: score every previous bigram (prev2, prev) against the heuristic tag
+                c2, c1 = cands2[unknown], cands1[unknown]
+                prob = self.log_trigram(c2[:, :, None], c1[:, None, :], j[:, None, None]) + e_unknown[:, None, None] + pi[unknown]
+                states += prob.size
+
+                # a bigram (prev, cur) only takes the score of a previous bigram that beats
+                # every previous bigram scanned before it, so keep the last such record per prev
+                flat = prob.reshape(len(unknown), prob.shape[1]*prob.shape[2])
+                record = np.empty(flat.shape, dtype=bool)
+                record[:, 0] = flat[:, 0] > -math.inf
+                record[:, 1:] = flat[:, 1:] > np.maximum.accumulate(flat, axis=1)[:, :-1]
+                record = record.reshape(prob.shape)
+
+                last_prev2 = prob.shape[1] - 1 - np.argmax(record[:, ::-1, :], axis=1)
+                score = np.take_along_axis(prob, last_prev2[:, None, :], axis=1)[:, 0, :]
+                new_pi[unknown, :, 0] = np.where(record.any(axis=1), score, -math.inf)
+
+                best = new_pi[active].reshape(len(active), new_pi.shape[1]*K).argmax(axis=1)
+                prev_tags[active, i] = cands1[active, best // K]
+                cur_tags[active, i] = cands[active, best % K]
+
+            if return_state:
+                for b in active[lengths[active] == i+1]:
+                    final[b] = (cands1[b].copy(), cands[b].copy(), new_pi[b].copy())
+            pi = new_pi
+            cands2, cands1 = cands1, cands
+        clock.lap('expand')
+        clock.count('states_expanded', states)
+
+        # Reconstruct the max probability sequence from the backpointers
         idx2tag = self.idx2tag
-        idx2bigram = self.idx2bigram
-        bigrams = self.bigrams
-        trigrams = self.trigrams
-        emissions = self.emissions
-        word2idx = self.word2idx
-        N = self.N
-
-        if self.kgram == 2: # bigram case
-            
-            # 2d matrix of probabilities 
-            pi = np.full((len(sequence), len(self.all_tags)), -math.inf)
-
-            pi[0] = 0 # set initial probabilities to 0 (log space)
-
-            bp = np.zeros((len(sequence), len(self.all_tags))) # back pointers
-
-            for i in range(1,len(sequence)): # iterate through all words after the first
-
-                word = sequence[i]
-
-                if word in self.word2idx: # if word is known
-                    
-                    for j, cur_tag in enumerate(self.all_tags): # iterate through all possible tags for the current one
-
-                        e = emissions[word2idx[word], tag2idx[cur_tag]]
-
-                        if e > 0: 
-                            e = log(e)
-                            for k, prev in enumerate(self.all_tags): # iterate through all possible tags for the previous one
-                                q = log(bigrams[k, tag2idx[cur_tag]]) # calculate bigram transition probability
-
-                                prod = q + e + pi[i-1, k] # new probability adds to probability corresponding to previous tag
-                                
-                                # if max for the current tag and word combination, update pi and point back to the chosen prev tag
-                                if prod > pi[i, j]: 
-                                    pi[i, j] = prod
-                                    bp[i, j] = k
-
-                else: # if word is unknown                    
-                    if(word[0].isupper()): # classify the word as a Proper Noun ig the first letter is upper case
-                        cur_tag = "NNP"
-                    else: 
-                        cur_tag = self.suffix_to_tag.get(word[-3:], None)  # default to none if suffix not in mapping
-                        
-                        if cur_tag == None: 
-                            cur_tag = self.prefix_to_tag.get(word[2:], None)  # default to none if suffix not in mapping
-                            if(cur_tag == None):
-                                cur_tag = "NN" # if none of the above conditions true, default to noun
-
-                    j = self.tag2idx[cur_tag]
-
-                    e = self.unigramsCount[cur_tag]/N 
-
-                    maxPtag = -math.inf  # Initialize with negative infinity
-                    
-                    for k in range(len(self.all_tags)):  # loop over all possible previous tags, find the one with max probability
-
-                        q = self.bigrams[k, j] # transition probability
-                    
-                        if e > 0:
-                            prob = log(q) + log(e) + pi[i-1, k]
-                            if prob > maxPtag:
-                                maxPtag = prob
-                                bp[i, j] = k
-                    
-                    pi[i, j] = maxPtag 
-
-            # Reconstruct the max probability sequence from the backpointers           
-            seq = ['O'] + [''] * (len(sequence) - 2) + [self.idx2tag[np.argmax(pi[-1])]]
-            for i in range(len(sequence)-2, 0, -1):
-                max_idx = np.argmax(pi[i+1])
-                seq[i] = self.idx2tag[int(bp[i+1, max_idx])]
-            return seq
-                
-        elif self.kgram == 3:
-                    
-            # 2d matrix of probabilities  [words, bigrams]
-            pi = np.full((len(sequence), len_bigramsCount), -math.inf)
-
-            pi[0] = 0 # set initial probabilities to 0 (log space)
-
-            bp = np.zeros((len(sequence), len_bigramsCount)) # back pointers
-            
-            for i in range(1,len(sequence)): # iterate through all words after the first
-
-                word = sequence[i]
-
-                if word in self.word2idx: # if word is known
-                    
-                    for j, cur_tag in enumerate(self.all_tags): # iterate through all possible tags for the current one
-                        
-                        e = emissions[word2idx[word], tag2idx[cur_tag]]
-
-                        if e > 0: 
-                            e = log(e)
-                            for index, k in enumerate(self.bigramsCount.keys()): # iterate through all possible previous bigrams
-
-                                if i == 1: # if first word, find bigram probability as only 1 start tag
-                                    q = log(bigrams[0, tag2idx[cur_tag]]) 
-                                else: # calculate trigram transition probability
-                                    q = log(trigrams[k[0], k[1], tag2idx[cur_tag]])
-
-                                prod = q + e + pi[i-1, index] # new probability adds to probability corresponding to previous bigram
-                                
-                                new_bigram = (k[1], tag2idx[cur_tag])
-                                bigram_idx = bigram2idx[new_bigram] # find the index of the new bigram
-
-                                # if max for the current tag and bigram combination, update pi and point back to the chosen prev bigram
-                                if prod > pi[i, bigram_idx]:
-                                    pi[i, bigram_idx] = prod
-                                    bp[i, bigram_idx] = k[1]
-        
-                else: # if word is unknown
-                    if(word[0].isupper()): # classify the word as a Proper Noun ig the first letter is upper case
-                        cur_tag = "NNP"
-                    else: 
-                        cur_tag = self.suffix_to_tag.get(word[-3:], None)  # default to none if suffix not in mapping
-                        
-                        if cur_tag == None: 
-                            cur_tag = self.prefix_to_tag.get(word[2:], None)  # default to none if suffix not in mapping
-                            if(cur_tag == None):
-                                cur_tag = "NN" # if none of the above conditions true, default to noun
-
-                    j = self.tag2idx[cur_tag]
-
-                    e = self.unigramsCount[cur_tag]/N  
-
-                    maxPtag = -math.inf  # Initialize with negative infinity
-                    
-                    index = 0
-
-                    for k in self.bigramsCount.keys():  # Loop over all possible previous bigrams (k is a bigram)
-
-                        q = self.trigrams[k[0],k[1], j] # transition probability
-
-                        new_bigram = (k[1], self.tag2idx[cur_tag])
-                        
-                        bigram_idx = self.bigram2idx[new_bigram]
-
-                        # If q and e are both non-zero, compute the Viterbi score
-                        if e > 0:
-
-                            prob = log(q) + log(e) + pi[i-1, index]
-                            
-                            if prob > maxPtag:
-                                maxPtag = prob
-                                bp[i, bigram_idx] = k[1]
-                                pi[i, bigram_idx] = maxPtag 
-                        index += 1 
-
-            # Reconstruct the max probability sequence from the backpointers           
-            seq = ['O'] + [''] * (len(sequence) - 2) + [idx2tag[idx2bigram[np.argmax(pi[-1])][1]]]
-            for i in range(len(sequence)-2, 0, -1):
-                max_idx = np.argmax(pi[i+1])
-                seq[i] = idx2tag[int(bp[i+1, max_idx])]
-            return seq
+        seqs = []
+        for b, n in enumerate(lengths):
+            if n == 1 and fresh[b]: # only the start word
+                seqs.append(['O'])
+            elif fresh[b]:
+                seqs.append(['O'] + [idx2tag[t] for t in prev_tags[b, 2:n]] + [idx2tag[cur_tags[b, n-1]]])
+            else: # the first word was only settled by this step
+                seqs.append([idx2tag[t] for t in prev_tags[b, 1:n]] + [idx2tag[cur_tags[b, n-1]]])
+        clock.lap('backtrack')
+        return (seqs, final) if return_state else seqs
+
+    def ngram_batch(self, sentences, width=None):
+        """ Tags a batch of sequences with PoS tags
+
+        Implements decoding with the order-kgram model (see get_ngrams), used when kgram > 3.
+        Rather than every (kgram-1)-tag history, the lattice only holds the states reached: the
+        longest suffix of each path seen as a context in training, down to the empty context.
+        Paths reaching the same state are scored alike from then on, so each state keeps its best
+        path, which makes this viterbi decoding. With width set, only the width best states of
+        each sentence are kept at each word: a width of 1 is greedy decoding, more is beam search.
+
+        Returns:
+            list[list[str]]: predicted tags for each sentence
+        """
+        if self.ngram_weights is None or self.kgram > self.ngram_order:
+            raise ValueError(f"kgram = {self.kgram} needs n-grams of that order: the model counted them up to "
+                             f"order {self.ngram_order}, train it with kgram = {self.kgram}")
+        if len(self.ngram_weights) != self.kgram: # kgram set without rebuilding the tables
+            raise ValueError(f"the n-gram tables are built for kgram = {len(self.ngram_weights)}, "
+                             f"call configure(kgram = {self.kgram}) to rebuild them")
+
+        word_ids, oov_ids, lengths, oov = self.encode(sentences)
+        n, L = word_ids.shape
+        start = self.tag2idx['O']
+        clock = self.clock('ngram')
+        states_expanded = 0
+
+        # the first word is followed by the longest seen suffix of the kgram-1 start tags
+        B = len(self.all_tags) + 1
+        history = [(start+1) * (B**m - 1) // (B - 1) for m in range(self.kgram)] # m start tags
+        seen = lookup_sparse(self.context_keys, self.contextCount, np.array(history)) > 0
+        first = history[np.flatnonzero(seen).max()]
+
+        # the lattice entries at the current word: sentence, state and score of each
+        sent, state, score = np.arange(n), np.full(n, first), np.zeros(n)
+        parents, tags = [None], [None] # back pointer and tag of every entry at every word
+        final = np.zeros(n, dtype=np.int64) # entry ending each sentence, at its last word
+
+        for i in range(1, L):
+            # extend every entry of the sentences still going with every candidate tag of their word
+            cands, e = self.candidate_tags(word_ids[:, i], oov_ids[:, i], oov)
+            K = cands.shape[1]
+            live = np.flatnonzero(lengths[sent] > i)
+            src = np.repeat(live, K)
+            tag, em = cands[sent[live]].ravel(), e[sent[live]].ravel()
+            valid = em > -math.inf
+            src, tag, em = src[valid], tag[valid], em[valid]
+
+            log_probs, nxt = self.ngram_transitions(state[src], tag)
+            new_sent, new_score = sent[src], score[src] + log_probs + em
+            states_expanded += len(src)
+
+            # keep the best path to each (sentence, state)
+            order = np.lexsort((-new_score, nxt, new_sent))
+            best = np.ones(len(order), dtype=bool)
+            best[1:] = (new_sent[order[1:]] != new_sent[order[:-1]]) | (nxt[order[1:]] != nxt[order[:-1]])
+            keep = order[best]
+
+            # rank them best first within each sentence, keeping the width best with width set
+            keep = keep[np.lexsort((-new_score[keep], new_sent[keep]))]
+            rank = np.arange(len(keep)) - np.searchsorted(new_sent[keep], new_sent[keep])
+            if width is not None:
+                keep, rank = keep[rank < width], rank[rank < width]
+
+            sent, state, score = new_sent[keep], nxt[keep], new_score[keep]
+            parents.append(src[keep])
+            tags.append(tag[keep])
+
+            # the best entry of each sentence ending at this word
+            ending = (rank == 0) & (lengths[sent] == i+1)
+            final[sent[ending]] = np.flatnonzero(ending)
+        clock.lap('expand')
+        clock.count('states_expanded', states_expanded)
+
+        # follow the back pointers from the best entry ending each sentence
+        path = np.full((n, L), start)
+        entry = np.zeros(n, dtype=np.int64)
+        for i in range(L-1, 0, -1):
+            ending = lengths == i+1
+            entry[ending] = final[ending]
+            live = lengths > i
+            path[live, i] = tags[i][entry[live]]
+            entry[live] = parents[i][entry[live]]
+
+        idx2tag = self.idx2tag
+        seqs = [[idx2tag[t] for t in path[b, :m]] for b, m in enumerate(lengths)]
+        clock.lap('backtrack')
+        return seqs
 
 if __name__ == "__main__":
-    pos_tagger = POSTagger()
+    parser = ArgumentParser()
 
-    train_data = load_data("data/train_x.csv", "data/train_y.csv")
-    dev_data = load_data("data/dev_x.csv", "data/dev_y.csv")
-    test_data = load_data("data/test_x.csv")
+    parser.add_argument("-t", "--tag", dest = "tag_path",
+        help = "only tag this id,word file, streaming it instead of evaluating on the dev set")
 
-    print(len(train_data[0]))
-    print(len(dev_data[0]))
-    print(len(test_data[0]))
+    parser.add_argument("-o", "--output", dest = "output_path", default = "test_y.csv",
+        help = "path of the id,tag predictions file to write")
 
-    pos_tagger.train(train_data)
+    parser.add_argument("-l", "--load", dest = "load_path",
+        help = "load a model saved with --save instead of training one")
 
-    evaluate(dev_data, pos_tagger)
+    parser.add_argument("-s", "--save", dest = "save_path",
+        help = "save the trained model to this directory")
 
-    # Predict tags for the test set
-    test_predictions = []
-    for sentence in test_data:
-        test_predictions.extend(pos_tagger.inference(sentence))
-    
-    # Write them to a file to update the leaderboard
-    # TODO
-    
-    with open("test_y.csv", "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["id", "tag"])  # write the headers first
-        for index, item in enumerate(test_predictions):
-            writer.writerow([index, item])
\ No newline at end of file
+    parser.add_argument("-p", "--processes", dest = "processes", type = int, default = 4,
+        help = "number of worker processes used by the evaluation")
+
+    parser.add_argument("-c", "--segment-cache", dest = "segment_cache_size", type = int,
+        help = "cache this many decoded segments, cut on the '.' words where the viterbi lattice holds a single state")
+
+    parser.add_argument("-L", "--segment-length", dest = "segment_length", type = int,
+        help = "decode documents longer than this in segments cut after '.', carrying the viterbi state between them")
+
+    parser.add_argument("-S", "--split-documents", dest = "split_documents", action = "store_true",
+        help = "decode pieces of documents longer than the segment length on different worker processes")
+
+    parser.add_argument("-H", "--no-heatmap", dest = "heatmap", action = "store_false",
+        help = "skip drawing the confusion matrix heatmap cm.png")
+
+    parser.add_argument("-m", "--metrics", dest = "metrics_path",
+        help = "collect per-phase timings and counts and write them here, as Prometheus text if it ends with .prom, as JSON otherwise")
+
+    args = parser.parse_args()
+
+    if args.load_path:
+        pos_tagger = POSTagger.load(args.load_path)
+        if args.metrics_path:
+            pos_tagger.metrics = Metrics()
+    else:
+        pos_tagger = POSTagger()
+        if args.metrics_path:
+            pos_tagger.metrics = Metrics()
+        train_data = load_corpus("data/train_x.csv", "data/train_y.csv")
+        pos_tagger.train(train_data)
+        print(len(train_data))
+
+    if args.segment_cache_size is not None:
+        pos_tagger.segment_cache_size = args.segment_cache_size
+
+    if args.segment_length is not None:
+        pos_tagger.segment_length = args.segment_length
+
+    if args.split_documents:
+        pos_tagger.split_documents = True
+
+    if args.save_path:
+        pos_tagger.save(args.save_path)
+
+    if args.tag_path:
+        tag_file(pos_tagger, args.tag_path, args.output_path)
+
+    else:
+        dev_data = load_corpus("data/dev_x.csv", "data/dev_y.csv")
+
+        print(len(dev_data))
+
+        evaluate(dev_data, pos_tagger, args.processes, 'cm.png' if args.heatmap else None)
+
+        # Predict tags for the test set and write them to a file to update the leaderboard
+        tag_file(pos_tagger, "data/test_x.csv", args.output_path)
+
+    if pos_tagger.segment_cache_size > 0:
+        print(f"segment cache: {pos_tagger.segment_hits} hits, {pos_tagger.segment_misses} misses")
+
+    if args.metrics_path:
+        pos_tagger.metrics.write(args.metrics_path)
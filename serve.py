@@ -0,0 +1,271 @@
+import asyncio
+import json
+import os
+import signal
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from pos_tagger import POSTagger
+from tagger_utils import Metrics, load_data, normalize_words
+
+
+""" Serves a POSTagger loaded once, tagging JSON-lines requests from stdin or a Unix socket.
+
+Every request is one line holding a JSON object such as
+    {"id": 7, "words": ["-DOCSTART-", "EU", "rejects", "German", "call", "."]}
+with the words of one document, as they appear in an id,word file, and gets back one line
+    {"id": 7, "tags": ["O", "NNP", "VBZ", "JJ", "NN", "."]}
+or {"id": 7, "error": "..."} if it cannot be tagged. Responses are written as soon as their
+batch is decoded, so a client sending several requests may get them back in another order.
+"""
+
+
+class MicroBatcher():
+    """Groups the documents submitted concurrently into batches decoded together.
+
+    A batch is closed once it holds max_batch documents, or max_delay seconds after its first
+    document arrived, so no document waits longer than that for others to join it. Batches are
+    decoded one at a time on a worker thread, which leaves the event loop free to read the next
+    requests meanwhile. Documents wait in a queue of at most queue_size, and submit blocks while
+    it is full, so clients sending faster than the model tags are slowed down instead of piling
+    up requests in memory.
+    """
+    def __init__(self, model, max_batch=32, max_delay=0.005, queue_size=1024):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue(queue_size)
+        self.executor = ThreadPoolExecutor(1) # the model's caches are not thread safe
+        self.documents = 0 # documents decoded so far
+        self.batches = 0 # batches decoded so far
+
+    async def submit(self, words):
+        """Queues a document, waiting for room in the queue.
+
+        Args:
+            words (list[str]): normalized words of the document
+
+        Returns:
+            asyncio.Future: resolves to the predicted tags of the document
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((words, future))
+        return future
+
+    async def next_batch(self):
+        """Waits for a document, then for more until the batch is full or its delay is over. """
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        """Decodes batches until cancelled. """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                predictions = await loop.run_in_executor(self.executor, self.model.inference_batch,
+                                                         [words for words, _ in batch])
+            except Exception as e: # fail the requests of this batch only
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.documents += len(batch)
+            self.batches += 1
+            for (words, future), tags in zip(batch, predictions):
+                if future.done(): # skip requests whose client went away
+                    continue
+                if len(tags) != len(words):
+                    future.set_exception(RuntimeError(f"tagged {len(words)} words with {len(tags)} tags"))
+                else:
+                    future.set_result(tags)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def document_words(request):
+    """Reads the words of a request.
+
+    Args:
+        request: decoded JSON request line
+
+    Returns:
+        list[str]: normalized words of the document
+
+    Raises:
+        ValueError: if the request does not hold a non-empty list of words
+    """
+    words = request.get("words") if isinstance(request, dict) else None
+    if not isinstance(words, list) or not words or not all(isinstance(word, str) for word in words):
+        raise ValueError("a request must be a JSON object whose words are a non-empty list of strings")
+    return normalize_words(pd.Series(words, dtype=object)).tolist()
+
+
+async def handle_requests(batcher, readline, send):
+    """Tags every request read until readline returns an empty line.
+
+    Requests are submitted as they are read, so the requests of one client are batched with
+    each other as well as with other clients', and each response is sent once its batch is done.
+
+    Args:
+        batcher (MicroBatcher): batcher decoding the documents
+        readline (coroutine function): returns the next request line, b"" at the end
+        send (coroutine function): writes one response line
+    """
+    async def respond(request_id, future):
+        try:
+            response = {"id": request_id, "tags": await future}
+        except Exception as e:
+            response = {"id": request_id, "error": str(e)}
+        await send(json.dumps(response))
+
+    pending = set()
+    while True:
+        line = await readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+
+        request_id = None
+        try:
+            request = json.loads(line)
+            if isinstance(request, dict):
+                request_id = request.get("id")
+            words = document_words(request)
+        except ValueError as e: # json.JSONDecodeError included
+            await send(json.dumps({"id": request_id, "error": str(e)}))
+            continue
+
+        task = asyncio.ensure_future(respond(request_id, await batcher.submit(words)))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def serve_stdin(batcher):
+    """Tags the requests read from stdin, writing the responses to stdout, until stdin ends. """
+    loop = asyncio.get_running_loop()
+
+    # read on a thread, as stdin may be a regular file, which the event loop cannot watch
+    with ThreadPoolExecutor(1) as reader:
+        async def readline():
+            return await loop.run_in_executor(reader, sys.stdin.buffer.readline)
+
+        async def send(line):
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+        await handle_requests(batcher, readline, send)
+
+
+async def serve_socket(batcher, path, line_limit=2**24):
+    """Tags the requests of every client connecting to the Unix socket path, until cancelled. """
+    async def client(reader, writer):
+        async def send(line):
+            writer.write(line.encode() + b"\n")
+            await writer.drain()
+        try:
+            await handle_requests(batcher, reader.readline, send)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass # the client went away or sent a line longer than line_limit
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(client, path, limit=line_limit)
+    print(f"listening on {path}", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        os.remove(path)
+
+
+async def main(model, args):
+    batcher = MicroBatcher(model, args.max_batch or model.batch_size, args.max_delay / 1000, args.queue_size)
+    worker = asyncio.ensure_future(batcher.run())
+
+    if args.socket_path:
+        server = asyncio.ensure_future(serve_socket(batcher, args.socket_path))
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, server.cancel)
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+    else:
+        await serve_stdin(batcher)
+
+    worker.cancel()
+    batcher.close()
+    if batcher.batches:
+        print(f"tagged {batcher.documents} documents in {batcher.batches} batches "
+              f"({batcher.documents / batcher.batches:.1f} per batch)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+
+    parser.add_argument("-l", "--load", dest = "load_path",
+        help = "load a model saved with pos_tagger.py --save instead of training one")
+
+    parser.add_argument("-x", "--sentences", dest = "sentence_path", default = "data/train_x.csv",
+        help = "path to the id,word file to train on when no model is loaded")
+
+    parser.add_argument("-y", "--tags", dest = "tag_path", default = "data/train_y.csv",
+        help = "path to the id,tag file of the training sentences")
+
+    parser.add_argument("-u", "--socket", dest = "socket_path",
+        help = "serve clients on this Unix socket instead of stdin and stdout")
+
+    parser.add_argument("-b", "--max-batch", dest = "max_batch", type = int,
+        help = "most documents decoded together, the model's batch_size by default")
+
+    parser.add_argument("-d", "--max-delay", dest = "max_delay", type = float, default = 5,
+        help = "milliseconds a document waits for others to join its batch")
+
+    parser.add_argument("-q", "--queue-size", dest = "queue_size", type = int, default = 1024,
+        help = "most documents waiting to be decoded before reading new requests pauses")
+
+    parser.add_argument("-c", "--segment-cache", dest = "segment_cache_size", type = int,
+        help = "cache this many decoded segments, cut on the '.' words where the viterbi lattice holds a single state")
+
+    parser.add_argument("-m", "--metrics", dest = "metrics_path",
+        help = "collect per-phase timings and counts and write them here on exit, as Prometheus text if it ends with .prom, as JSON otherwise")
+
+    args = parser.parse_args()
+
+    if args.load_path:
+        pos_tagger = POSTagger.load(args.load_path)
+    else:
+        pos_tagger = POSTagger()
+        pos_tagger.train(load_data(args.sentence_path, args.tag_path))
+
+    if args.segment_cache_size is not None:
+        pos_tagger.segment_cache_size = args.segment_cache_size
+
+    if args.metrics_path:
+        pos_tagger.metrics = Metrics()
+
+    asyncio.run(main(pos_tagger, args))
+
+    if args.metrics_path:
+        pos_tagger.metrics.write(args.metrics_path)
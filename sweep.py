@@ -0,0 +1,160 @@
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import pandas as pd
+
+import pos_tagger
+from pos_tagger import POSTagger
+from tagger_utils import encode_tags, load_corpus
+
+
+""" Evaluates a grid of hyperparameters on the dev set, counting the training data only once. """
+
+# dev set of a sweep worker process: sentences, gold tag indices and unknown word mask
+dev_sentences, dev_gold, dev_unknown = None, None, None
+# hyperparameters of the trained model, which every configuration starts from
+base_hyperparameters = None
+
+def attach_sweep(path, corpus):
+    """Sweep worker initializer: memory-maps the shared model and keeps the dev set. """
+    global dev_sentences, dev_gold, dev_unknown, base_hyperparameters
+    pos_tagger.attach_model(path)
+    model = pos_tagger.worker_model
+    base_hyperparameters = {name: getattr(model, name) for name in model.HYPERPARAMETERS}
+    dev_sentences = corpus
+    # looked up once per distinct tag and word, then spread over the tokens
+    dev_gold = encode_tags(model.tag2idx, [corpus.tags])[corpus.tag_ids]
+    dev_unknown = ~pd.Index(corpus.words).isin(model.all_words)[corpus.word_ids]
+
+
+def run_point(point):
+    """Rebuilds the worker's tables for one configuration and tags the dev set with them.
+
+    Args:
+        point (dict): hyperparameters of the configuration, by name
+
+    Returns:
+        dict: the hyperparameters, token and unknown token accuracies and seconds spent
+    """
+    model = pos_tagger.worker_model
+
+    start = time.perf_counter()
+    model.configure(**dict(base_hyperparameters, **point)) # undo the previous configuration's changes
+    tables = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predictions = model.inference_batch(dev_sentences)
+    decode = time.perf_counter() - start
+
+    correct = (encode_tags(model.tag2idx, predictions) == dev_gold) & (dev_gold >= 0)
+    return dict(point, token_acc=correct.mean(), unk_token_acc=correct[dev_unknown].mean(),
+                tables_seconds=tables, decode_seconds=decode)
+
+
+def lambda_grid(step):
+    """Returns every (lambda1, lambda2, lambda3) summing to 1 with the given step, each above 0. """
+    n = int(round(1 / step))
+    return [{"lambda1": i / n, "lambda2": j / n, "lambda3": (n - i - j) / n}
+            for i in range(1, n) for j in range(1, n - i)]
+
+
+def parse_grid(specs):
+    """Turns name=value1,value2,... specs into the list of every combination of their values.
+
+    Values are read as JSON, so 0.1, 3 and true give a float, an int and a bool.
+    """
+    names, values = [], []
+    for spec in specs:
+        name, _, choices = spec.partition("=")
+        names.append(name)
+        values.append([json.loads(value) for value in choices.split(",")])
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def sweep(model, points, corpus, processes=4):
+    """Evaluates each configuration on a dev set, one configuration per task.
+
+    The model is trained once by the caller and saved once to shared memory. Every worker
+    memory-maps it, and for each configuration only rebuilds the transition tables from the
+    counts (see POSTagger.configure) before tagging the whole dev set.
+
+    Args:
+        model (POSTagger): trained model
+        points (list[dict]): hyperparameters of each configuration, by name
+        corpus (Corpus): tagged dev documents, sent once to each worker
+        processes (int): number of worker processes
+
+    Returns:
+        pd.DataFrame: one row per configuration, in the order given, with its hyperparameters,
+            token_acc, unk_token_acc, tables_seconds and decode_seconds
+    """
+    for point in points: # fail before starting the workers
+        for name in point:
+            if name not in POSTagger.HYPERPARAMETERS:
+                raise ValueError(f"unknown hyperparameter {name}")
+
+    path = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        model.save(path)
+        with Pool(processes=processes, initializer=attach_sweep, initargs=(path, corpus)) as pool:
+            results = []
+            for i, result in enumerate(pool.imap(run_point, points)):
+                results.append(result)
+                print(f"{i+1}/{len(points)} {json.dumps(points[i])}: token acc {result['token_acc']:.4f}",
+                      file=sys.stderr)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+
+    parser.add_argument("-x", "--train-sentences", dest = "train_x", default = "data/train_x.csv",
+        help = "path to the id,word file to train on")
+
+    parser.add_argument("-y", "--train-tags", dest = "train_y", default = "data/train_y.csv",
+        help = "path to the id,tag file of the training sentences")
+
+    parser.add_argument("-X", "--dev-sentences", dest = "dev_x", default = "data/dev_x.csv",
+        help = "path to the id,word file to evaluate on")
+
+    parser.add_argument("-Y", "--dev-tags", dest = "dev_y", default = "data/dev_y.csv",
+        help = "path to the id,tag file of the dev sentences")
+
+    parser.add_argument("-g", "--grid", dest = "grid", nargs = "+", default = [],
+        help = "hyperparameter values to try, as name=value1,value2,... (every combination is run)")
+
+    parser.add_argument("-L", "--lambda-step", dest = "lambda_step", type = float,
+        help = "also try every lambda1, lambda2, lambda3 summing to 1 on a grid of this step")
+
+    parser.add_argument("-p", "--processes", dest = "processes", type = int, default = 4,
+        help = "number of worker processes")
+
+    parser.add_argument("-o", "--output", dest = "output_path", default = "sweep.csv",
+        help = "path of the CSV results file to write")
+
+    args = parser.parse_args()
+
+    points = parse_grid(args.grid)
+    if args.lambda_step:
+        points = [dict(point, **lambdas) for point in points for lambdas in lambda_grid(args.lambda_step)]
+
+    start = time.perf_counter()
+    model = POSTagger()
+    model.train(load_corpus(args.train_x, args.train_y))
+    print(f"Training Runtime: {time.perf_counter()-start:.2f} seconds.")
+
+    start = time.perf_counter()
+    results = sweep(model, points, load_corpus(args.dev_x, args.dev_y), args.processes)
+    print(f"Sweep Runtime: {time.perf_counter()-start:.2f} seconds for {len(points)} configurations.")
+
+    results.to_csv(args.output_path, index=False)
+    print(results.sort_values("token_acc", ascending=False).head(10).to_string(index=False))
@@ -30,3 +30,12 @@ NGRAMM = 3
 TNT_UNK = True
 UNK_C = 10 #words with count to be considered
 UNK_M = 10 #substring length to be considered
+
+## Token ending a segment for the segment-level decode cache
+SEGMENT_END = '.'
+
+## Upper bounds in seconds of the per-document latency histogram buckets of Metrics
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+## Saved model format, bump when the files written by POSTagger.save change
+MODEL_VERSION = 4
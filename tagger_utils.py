@@ -1,10 +1,11 @@
 import pandas as pd
-from tqdm import tqdm 
 import numpy as np
 import seaborn as sn
 import matplotlib.pyplot as plt
 from tagger_constants import *
+import json
 import time
+from collections import defaultdict
 
 # Start the stopwatch
 
@@ -24,36 +25,105 @@ def infer_sentences(model, sentences, start):
     """
     res = {}
 
-    # start_time = time.time()
+    # decode the whole chunk in length-bucketed batches
+    predictions = model.inference_batch(sentences)
 
     for i in range(len(sentences)):
-        res[start+i] = model.inference(sentences[i])
-        # break
-    
-    # end_time = time.time()
-
-    # print(end_time-start_time)
+        res[start+i] = predictions[i]
     return res
 
+def infer_pieces(model, pieces, resume, start):
+    """Like infer_sentences, for pieces of documents resuming from a lattice state.
+
+    Args:
+        model (POSTagger): model used for inference
+        pieces (list[list[str]]): pieces to infer by single process
+        resume (list): lattice state each piece resumes from (see POSTagger.independent_pieces)
+        start (int): index of the first piece in the original list of pieces
+
+    Returns:
+        dict: index, predicted tags for each piece in pieces
+    """
+    predictions = model.inference_batch(pieces, resume)
+    return {start+i: tags for i, tags in enumerate(predictions)}
+
     
-def compute_prob(model, sentences, tags, start):
+def balanced_chunks(lengths, n_chunks):
+    """Splits sentences into about n_chunks chunks holding the same number of tokens.
+
+    Sentences are taken longest first, so the most expensive chunks come first and
+    sentences of similar length end up in the same chunk.
+
+    Args:
+        lengths (list[int]): length of each sentence
+        n_chunks (int): number of chunks wanted
+
+    Returns:
+        list[list[int]]: sentence indices of each chunk
     """
+    order = np.argsort(lengths, kind='stable')[::-1]
+    target = sum(lengths) / n_chunks
+
+    chunks, chunk, size = [], [], 0
+    for i in order:
+        chunk.append(int(i))
+        size += lengths[i]
+        if size >= target:
+            chunks.append(chunk)
+            chunk, size = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def add_sparse_counts(keys, counts, new_keys):
+    """Adds the occurrences of new_keys to counts stored sparsely.
 
     Args:
-        model (POSTagger): model used for inference
-        sentences (list[str]): list of sentences 
-        sentences (list[str]): list of tags
-        start (int): index of first sentence in sentences in the original list of sentences
+        keys (np.ndarray): sorted keys counted so far
+        counts (np.ndarray): count of each key
+        new_keys (np.ndarray): keys to count, once per occurrence and in any order
+
+    Returns:
+        keys (np.ndarray): sorted keys seen so far
+        counts (np.ndarray): count of each key
+    """
+    keys, inverse = np.unique(np.concatenate([keys, new_keys]), return_inverse=True)
+    weights = np.concatenate([counts, np.ones(len(new_keys))])
+    return keys, np.bincount(inverse.ravel(), weights=weights, minlength=len(keys)).astype(np.int64)
 
+def lookup_sparse(keys, counts, query):
+    """Looks up the counts of keys stored sparsely.
+
+    Args:
+        keys (np.ndarray): sorted keys counted
+        counts (np.ndarray): count of each key
+        query (np.ndarray): keys to look up, of any shape
 
     Returns:
-        dict: index, probability for each sentence,tag pair
+        np.ndarray: count of each query key, 0 for the keys never counted
     """
-    res = {}
-    for i in range(len(sentences)):
-        res[start+i] = model.sequence_probability(sentences[i], tags[i])
-    return res
-    
+    pos = np.minimum(np.searchsorted(keys, query), len(keys)-1)
+    return np.where(keys[pos] == query, counts[pos], 0)
+
+def logsumexp(a, axis):
+    """Computes log(sum(exp(a))) along axis without overflow, -inf where every value is -inf. """
+    m = a.max(axis=axis, keepdims=True)
+    m = np.where(m > -np.inf, m, 0)
+    with np.errstate(divide='ignore'):
+        return np.log(np.exp(a - m).sum(axis=axis)) + np.squeeze(m, axis=axis)
+
+def rebase_codes(codes, old_base, new_base):
+    """Re-encodes sequences written as bijective base old_base numbers (every digit from 1 to
+    old_base-1) in base new_base, keeping their digits, e.g. when the tagset grows.
+    """
+    codes = np.array(codes, dtype=np.int64)
+    rebased = np.zeros_like(codes)
+    scale = 1
+    while codes.any():
+        rebased += codes % old_base * scale
+        codes //= old_base
+        scale *= new_base
+    return rebased
 
 #from https://stackoverflow.com/questions/6294179/how-to-find-all-occurrences-of-an-element-in-a-list    
 def indices(lst, element):
@@ -66,73 +136,398 @@ def indices(lst, element):
             return result
         result.append(offset)
 
+def normalize_words(words):
+    """Strips the words of a word column and applies the CAPITALIZATION setting.
+
+    Args:
+        words (pd.Series): raw words
+
+    Returns:
+        pd.Series: cleaned words, -DOCSTART- is always lowercased
+    """
+    words = words.str.strip()
+    if CAPITALIZATION:
+        return words.where(words != '-DOCSTART-', '-docstart-')
+    return words.str.lower()
+
 def load_data(sentence_file, tag_file=None):
     """Loads data from two files: one containing sentences and one containing tags.
 
     tag_file is optional, so this function can be used to load the test data.
 
-    Suggested to split the data by the document-start symbol.
+    Each column is read once and cut into documents at the document-start symbol,
+    rather than looked up row by row.
 
     """
-    df_sentences = pd.read_csv(open(sentence_file), keep_default_na=False)
-    doc_start_indexes = df_sentences.index[df_sentences['word'] == '-DOCSTART-'].tolist()
-    num_sentences = len(doc_start_indexes)
+    df_sentences = pd.read_csv(sentence_file, keep_default_na=False)
 
-    sentences = [] # each sentence is a list of tuples (index,word)
-    if tag_file:
-        df_tags = pd.read_csv(open(tag_file))
-        tags = []
-    for i in tqdm(range(num_sentences)):
-        index = doc_start_indexes[i]
-        if i == num_sentences-1:
-            # handle last sentence
-            next_index = len(df_sentences)
-        else:
-            next_index = doc_start_indexes[i+1]
-
-        sent = []
-        tag = []
-        for j in range(index, next_index):
-            # Check the data type of the word and output the word and j if it is not a string
-            word = df_sentences['word'][j].strip()
-            if not CAPITALIZATION or word == '-DOCSTART-':
-                word = word.lower()
-            sent.append(word)
-            if tag_file:
-                tag.append((df_tags['tag'][j]))
-        sentences.append(sent)
-        if tag_file: 
-            tags.append(tag)
+    # document boundaries: every -DOCSTART- row starts a new sentence
+    doc_starts = np.flatnonzero(df_sentences['word'].to_numpy() == '-DOCSTART-')
+    doc_ends = np.append(doc_starts[1:], len(df_sentences))
+
+    words = normalize_words(df_sentences['word']).tolist()
+
+    sentences = [words[i:j] for i, j in zip(doc_starts, doc_ends)]
 
     if tag_file:
+        tag_list = pd.read_csv(tag_file)['tag'].tolist()
+        tags = [tag_list[i:j] for i, j in zip(doc_starts, doc_ends)]
         return sentences, tags
 
     return sentences
 
-def confusion_matrix(tag2idx,idx2tag, pred, gt, fname):
-    """Saves the confusion matrix
+def load_corpus(sentence_file, tag_file=None):
+    """Loads the same documents as load_data into a Corpus.
+
+    Args:
+        sentence_file (str): path to the id,word file
+        tag_file (str): path to the id,tag file of the same rows, optional
+
+    Returns:
+        Corpus: the documents, tagged if tag_file is given
+    """
+    df_sentences = pd.read_csv(sentence_file, keep_default_na=False)
+
+    # as in load_data, documents start at every -DOCSTART- row and rows before the first one are skipped
+    doc_starts = np.flatnonzero(df_sentences['word'].to_numpy() == '-DOCSTART-')
+    first = doc_starts[0] if len(doc_starts) else len(df_sentences)
+    offsets = np.append(doc_starts, len(df_sentences)) - first
+
+    word_ids, words = pd.factorize(normalize_words(df_sentences['word'].iloc[first:]))
+    if not tag_file:
+        return Corpus(words, word_ids, offsets)
+
+    tag_ids, tags = pd.factorize(pd.read_csv(tag_file)['tag'].iloc[first:])
+    return Corpus(words, word_ids, offsets, tags, tag_ids)
+
+class Corpus():
+    """Documents stored as flat integer arrays instead of lists of strings.
+
+    Every token is an int32 index into the words vocabulary, which holds each distinct word
+    once, and the tokens of document d are word_ids[offsets[d]:offsets[d+1]]. Tagged corpora
+    store their tags the same way, in tag_ids and tags. A corpus takes a small fraction of the
+    memory of the lists of load_data and pickles quickly, so it is cheap to send to worker
+    processes. POSTagger.train, evaluate and the decoders accept it wherever they accept lists.
+
+    Indexing a corpus gives the words of a document as a list, like the sentences of load_data.
+    """
+    def __init__(self, words, word_ids, offsets, tags=None, tag_ids=None):
+        self.words = np.asarray(words, dtype=object)
+        self.word_ids = np.asarray(word_ids, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.tags = None if tags is None else np.asarray(tags, dtype=object)
+        self.tag_ids = None if tag_ids is None else np.asarray(tag_ids, dtype=np.int32)
+
+    @classmethod
+    def from_lists(cls, sentences, tags=None):
+        """Builds a corpus from lists of words and, optionally, of tags, as load_data returns them. """
+        offsets = np.concatenate([[0], np.cumsum([len(s) for s in sentences], dtype=np.int64)])
+        word_ids, words = pd.factorize(np.array([w for s in sentences for w in s], dtype=object))
+        if tags is None:
+            return cls(words, word_ids, offsets)
+        tag_ids, tag_vocab = pd.factorize(np.array([t for seq in tags for t in seq], dtype=object))
+        return cls(words, word_ids, offsets, tag_vocab, tag_ids)
+
+    @property
+    def lengths(self):
+        """Number of tokens of each document. """
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, d):
+        return self.words[self.word_ids[self.offsets[d]:self.offsets[d+1]]].tolist()
+
+    def sentences(self):
+        """Returns the words of every document, as load_data does. """
+        words = self.words[self.word_ids].tolist()
+        return [words[i:j] for i, j in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def tag_lists(self):
+        """Returns the tags of every document, as load_data does. """
+        tags = self.tags[self.tag_ids].tolist()
+        return [tags[i:j] for i, j in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def subset(self, docs):
+        """Returns some of the documents as a new corpus, whose vocabulary only holds their words.
+
+        Args:
+            docs (list[int]): indices of the documents, in the order wanted
+        """
+        docs = np.asarray(docs, dtype=np.int64)
+        return self.slice(docs, np.zeros(len(docs), dtype=np.int64), self.lengths[docs])
+
+    def slice(self, docs, starts, ends):
+        """Returns the tokens starts[i]:ends[i] of each document docs[i] as a new corpus, whose
+        vocabulary only holds their words. """
+        docs = np.asarray(docs, dtype=np.int64)
+        starts = np.asarray(starts, dtype=np.int64)
+        lengths = np.asarray(ends, dtype=np.int64) - starts
+        # position of every token of the slices in the flat arrays
+        index = np.repeat(self.offsets[docs] + starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        used, word_ids = np.unique(self.word_ids[index], return_inverse=True)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        if self.tags is None:
+            return Corpus(self.words[used], word_ids.ravel(), offsets)
+        return Corpus(self.words[used], word_ids.ravel(), offsets, self.tags, self.tag_ids[index])
+
+def document_lengths(sentences):
+    """Returns the number of tokens of each document of a Corpus or a list of sentences. """
+    if isinstance(sentences, Corpus):
+        return sentences.lengths
+    return np.array([len(s) for s in sentences], dtype=np.int64)
+
+def take_documents(sentences, docs):
+    """Returns some documents of a Corpus, as a Corpus, or of a list of sentences, as a list. """
+    if isinstance(sentences, Corpus):
+        return sentences.subset(docs)
+    return [sentences[d] for d in docs]
+
+def slice_documents(sentences, docs, starts, ends):
+    """Returns the tokens starts[i]:ends[i] of each document docs[i] of a Corpus, as a Corpus,
+    or of a list of sentences, as a list. """
+    if isinstance(sentences, Corpus):
+        return sentences.slice(docs, starts, ends)
+    return [sentences[d][i:j] for d, i, j in zip(docs, starts, ends)]
+
+def word_positions(sentences, docs, word):
+    """Returns the positions of word in each document docs[i] of a Corpus or a list of sentences. """
+    if isinstance(sentences, Corpus):
+        code = np.flatnonzero(sentences.words == word)
+        if not len(code):
+            return [np.zeros(0, dtype=np.int64) for _ in docs]
+        offsets = sentences.offsets
+        return [np.flatnonzero(sentences.word_ids[offsets[d]:offsets[d+1]] == code[0]) for d in docs]
+    return [np.flatnonzero(np.array(sentences[d], dtype=object) == word) for d in docs]
+
+def segment_cuts(length, points, size, hard=True):
+    """Chooses where to cut a document into segments of about size tokens.
+
+    Every segment ends on a cut and the next one starts on it, so consecutive segments share
+    that token. A segment ends on the last of points that keeps it within size tokens. When
+    none does, it is cut after size tokens if hard, or otherwise on the next of points, past
+    which it is not cut at all.
+
+    Args:
+        length (int): number of tokens of the document
+        points (np.ndarray): positions the document may be cut at, increasing
+        size (int): most tokens of a segment, at least 2
+        hard (bool): whether segments may be cut anywhere to stay within size tokens
+
+    Returns:
+        list[int]: positions of the cuts, increasing
+    """
+    points = points[(points > 0) & (points < length - 1)] # segments of at least 2 tokens
+    cuts, start = [], 0
+    while length - start > size:
+        k = np.searchsorted(points, start + size - 1, side='right') - 1
+        if k >= 0 and points[k] > start:
+            start = int(points[k])
+        elif hard:
+            start = start + size - 1
+        else:
+            k = np.searchsorted(points, start, side='right')
+            if k == len(points):
+                break
+            start = int(points[k])
+        cuts.append(start)
+    return cuts
+
+def stream_documents(sentence_file, chunksize=50000):
+    """Reads an id,word file in chunks and yields it one document at a time.
+
+    Only the current chunk and the document being assembled are held in memory.
+    As in load_data, rows before the first document-start symbol are skipped.
+
+    Args:
+        sentence_file (str): path to the id,word file
+        chunksize (int): number of rows read at once
+
+    Yields:
+        tuple(list[int], list[str]): ids and words of each document
+    """
+    doc_ids, doc_words = None, None # document being assembled
+
+    for chunk in pd.read_csv(sentence_file, keep_default_na=False, chunksize=chunksize):
+        chunk_ids = chunk['id'].tolist()
+        chunk_words = normalize_words(chunk['word']).tolist()
+        doc_starts = np.flatnonzero(chunk['word'].to_numpy() == '-DOCSTART-').tolist()
+
+        # cut the chunk at every document start, the first piece continues the previous document
+        bounds = [0] + doc_starts + [len(chunk)]
+        for i, j in zip(bounds[:-1], bounds[1:]):
+            if i == j:
+                continue
+            if i in doc_starts:
+                if doc_ids is not None:
+                    yield doc_ids, doc_words
+                doc_ids, doc_words = chunk_ids[i:j], chunk_words[i:j]
+            elif doc_ids is not None:
+                doc_ids.extend(chunk_ids[i:j])
+                doc_words.extend(chunk_words[i:j])
+
+    if doc_ids is not None:
+        yield doc_ids, doc_words
+
+def encode_tags(tag2idx, sequences):
+    """Flattens tag sequences into one array of tag indices.
+
+    Args:
+        tag2idx (dict): tag to index dictionary
+        sequences (iterable[list[str]]): tag sequences
+
+    Returns:
+        np.ndarray: index of every tag, -1 for tags missing from tag2idx
+    """
+    flat = [t for seq in sequences for t in seq]
+    if not flat:
+        return np.zeros(0, dtype=np.int64)
+    return pd.Index(sorted(tag2idx, key=tag2idx.get)).get_indexer(flat).astype(np.int64)
+
+def tag_confusion(gold, pred, n_tags):
+    """Counts every (gold tag, predicted tag) pair with a single bincount.
+
+    Args:
+        gold (np.ndarray): gold tag index of every token, -1 tokens are left out
+        pred (np.ndarray): predicted tag index of every token
+        n_tags (int): number of tags
+
+    Returns:
+        np.ndarray: (n_tags, n_tags) matrix counting the tokens of each gold tag (rows) given each predicted tag (columns)
+    """
+    keep = (gold >= 0) & (pred >= 0)
+    return np.bincount(gold[keep] * n_tags + pred[keep], minlength=n_tags*n_tags).reshape(n_tags, n_tags)
+
+def confusion_matrix(tag2idx,idx2tag, pred, gt, fname=None):
+    """Computes the confusion matrix, and saves it as a heatmap
 
     Args:
         tag2idx (dict): tag to index dictionary
         idx2tag (dict): index to tag dictionary
         pred (list[list[str]]): list of predicted tags
-        gt (type): description
-        fname (str): filename to save confusion matrix
-
-    """
-    matrix = np.zeros((len(tag2idx), len(tag2idx))) #-2 for start/end states 
-    flat_pred = []
-    flat_y = []
-    for p in pred:
-        flat_pred.extend(p)
-    for true in gt:
-        flat_y.extend(true)
-    for i in range(len(flat_pred)):
-        idx_pred = tag2idx[flat_pred[i]]
-        idx_y = tag2idx[flat_y[i]]
-        matrix[idx_y][idx_pred] += 1
-    df_cm = pd.DataFrame(matrix, index = [idx2tag[i] for i in range(len(tag2idx))],
-                columns = [idx2tag[i] for i in range(len(tag2idx))])
+        gt (list[list[str]]): list of gold tags
+        fname (str): filename to save the heatmap to, None to skip drawing it
+
+    Returns:
+        np.ndarray: counts of each (gold tag, predicted tag) pair, indexed by tag index
+    """
+    matrix = tag_confusion(encode_tags(tag2idx, gt), encode_tags(tag2idx, pred), len(tag2idx))
+    if fname is not None:
+        save_heatmap(matrix, idx2tag, fname)
+    return matrix
+
+def save_heatmap(matrix, idx2tag, fname):
+    """Saves a confusion matrix indexed by tag index as a heatmap. """
+    df_cm = pd.DataFrame(matrix, index = [idx2tag[i] for i in range(len(matrix))],
+                columns = [idx2tag[i] for i in range(len(matrix))])
     plt.figure(figsize = (20,14))
     sn.heatmap(df_cm, annot=False)
-    plt.savefig(fname)
\ No newline at end of file
+    plt.savefig(fname)
+
+
+class Metrics():
+    """Wall time of each phase of training and decoding, token counts and a histogram of
+    per-document latencies, collected by a POSTagger whose metrics attribute is set.
+
+    Instances are plain picklable counters, so the metrics of worker processes can be sent
+    back and added together with merge.
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float) # wall time of each phase
+        self.calls = defaultdict(int) # number of times each phase ran
+        self.counts = defaultdict(int) # tokens, oov_tokens, documents, states_expanded, ...
+        self.latency = np.zeros(len(LATENCY_BUCKETS)+1, dtype=np.int64) # documents per bucket, the last one unbounded
+        self.latency_sum = 0.0
+
+    def clock(self, prefix):
+        """Starts timing a piece of work made of consecutive phases, named prefix.phase. """
+        return PhaseClock(self, prefix)
+
+    def merge(self, other):
+        """Adds the metrics of other to these. """
+        for name, seconds in other.seconds.items():
+            self.seconds[name] += seconds
+        for name, calls in other.calls.items():
+            self.calls[name] += calls
+        for name, count in other.counts.items():
+            self.counts[name] += count
+        self.latency += other.latency
+        self.latency_sum += other.latency_sum
+
+    def to_dict(self):
+        """Returns the metrics as a JSON serializable dict. """
+        tokens = self.counts.get('tokens', 0)
+        return {'phases': {name: {'seconds': self.seconds[name], 'calls': self.calls[name]} for name in sorted(self.seconds)},
+                'counts': dict(sorted(self.counts.items())),
+                'oov_rate': self.counts.get('oov_tokens', 0) / tokens if tokens else 0.0,
+                'latency': {'buckets_seconds': list(LATENCY_BUCKETS) + ['+Inf'], 'documents': self.latency.tolist(),
+                            'sum_seconds': self.latency_sum, 'count': int(self.latency.sum())}}
+
+    def write(self, path):
+        """Writes the metrics to path, in the Prometheus text format if it ends with .prom, as JSON otherwise. """
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format. """
+        lines = ['# HELP pos_tagger_phase_seconds_total Wall time spent in each phase.',
+                 '# TYPE pos_tagger_phase_seconds_total counter']
+        lines += [f'pos_tagger_phase_seconds_total{{phase="{name}"}} {self.seconds[name]}' for name in sorted(self.seconds)]
+        lines += ['# HELP pos_tagger_phase_calls_total Number of times each phase ran.',
+                  '# TYPE pos_tagger_phase_calls_total counter']
+        lines += [f'pos_tagger_phase_calls_total{{phase="{name}"}} {self.calls[name]}' for name in sorted(self.calls)]
+        for name in sorted(self.counts):
+            lines += [f'# TYPE pos_tagger_{name}_total counter', f'pos_tagger_{name}_total {self.counts[name]}']
+
+        lines += ['# HELP pos_tagger_document_latency_seconds Time taken to tag each document.',
+                  '# TYPE pos_tagger_document_latency_seconds histogram']
+        cumulative = np.cumsum(self.latency)
+        for bound, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], cumulative):
+            lines.append(f'pos_tagger_document_latency_seconds_bucket{{le="{bound}"}} {count}')
+        lines += [f'pos_tagger_document_latency_seconds_sum {self.latency_sum}',
+                  f'pos_tagger_document_latency_seconds_count {cumulative[-1]}']
+        return '\n'.join(lines) + '\n'
+
+
+class PhaseClock():
+    """Times consecutive phases of one piece of work: each lap charges the time since the
+    previous one (or since the clock started) to a phase. """
+    def __init__(self, metrics, prefix):
+        self.metrics = metrics
+        self.prefix = prefix
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        name = self.prefix + '.' + phase
+        self.metrics.seconds[name] += now - self.last
+        self.metrics.calls[name] += 1
+        self.last = now
+
+    def count(self, name, n):
+        self.metrics.counts[name] += int(n)
+
+    def documents(self, n):
+        """Counts n documents, each taking the time since the clock started. """
+        latency = time.perf_counter() - self.start
+        self.metrics.latency[np.searchsorted(LATENCY_BUCKETS, latency)] += n
+        self.metrics.latency_sum += latency * n
+        self.metrics.counts['documents'] += n
+
+
+class NullClock():
+    """Stands for a PhaseClock when instrumentation is off, doing nothing. """
+    def lap(self, phase):
+        pass
+
+    def count(self, name, n):
+        pass
+
+    def documents(self, n):
+        pass
+
+NULL_CLOCK = NullClock()
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from pos_tagger import POSTagger
+from tagger_utils import load_data
+
+
+""" Checks of the decoders, trained on the first 200 documents of the dev set. """
+
+DEV_X = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "dev_x.csv")
+DEV_Y = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "dev_y.csv")
+
+
+@pytest.fixture(scope="module")
+def dev_data():
+    sentences, tags = load_data(DEV_X, DEV_Y)
+    return sentences[:200], tags[:200]
+
+
+@pytest.fixture(scope="module")
+def ngram_model(dev_data):
+    model = POSTagger()
+    model.kgram = 4
+    model.train(dev_data)
+    return model
+
+
+@pytest.mark.parametrize("decoder", [1, 2, 3])
+def test_inference_with_ngrams(ngram_model, dev_data, decoder):
+    """inference tags a sentence like inference_batch with every decoder when kgram > 3. """
+    ngram_model.model = decoder
+    sentence = dev_data[0][0][:60]
+    tags = ngram_model.inference(sentence)
+    assert len(tags) == len(sentence)
+    assert tags == ngram_model.inference_batch([sentence])[0]
+
+
+def test_ngrams_above_trained_order(ngram_model, dev_data):
+    """Decoding with a kgram above the order counted asks to train with it. """
+    ngram_model.kgram = 5
+    try:
+        with pytest.raises(ValueError, match="train it with kgram = 5"):
+            ngram_model.inference_batch(dev_data[0][:1])
+    finally:
+        ngram_model.kgram = 4
+
+
+def test_update_compacts_suffix_tries(dev_data):
+    """An update keeps no trie node for suffixes whose words all stopped being rare. """
+    sentences, tags = dev_data
+    model = POSTagger()
+    model.train((sentences[:100], tags[:100]))
+    for start in range(100, 200, 25):
+        model.update((sentences[start:start+25], tags[start:start+25]))
+    nodes = sorted(node for ids in model.suffix_ids for node in ids.values())
+    assert nodes == list(range(len(model.suffix_ptr) - 1))
+    assert (model.suffix_ptr[1:] > model.suffix_ptr[:-1]).all()